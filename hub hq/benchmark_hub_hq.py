@@ -0,0 +1,915 @@
+# Offline benchmark for the Hub HQ sync scripts.
+#
+# Drives mobilize_updates, subscribe_to_ea, get_hq and both main() flows against in-process stand-ins for Google Sheets
+# (gspread-like worksheets), Redshift (rs.query/rs.copy backed by SQLite) and EveryAction (a VAN upsert stub with
+# configurable latency and 429 rate), using synthetic hubs. For each hub size it reports wall time, rows/sec, API calls
+# and bytes transferred per stage, so regressions show up before deploy. Nothing here touches production APIs.
+#
+# Usage (from this folder):
+#   python benchmark_hub_hq.py --rows 100 1000 10000 100000 --hubs 2 --van-latency 0.01 --van-429-rate 0.01
+
+import argparse
+import datetime
+import json
+import os
+import random
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+import requests
+from parsons import Table
+from parsons.utilities.api_connector import APIConnector
+
+import hub_hq_utils
+from hub_hq_utils import HQSnapshotStore, HubSyncState, SheetWriteBatch, UpsertCache, clients, read_hidden_hq
+
+# Don't throttle calls to the stand-ins. This has to happen before the scripts create their rate limiters
+for kind in ['SHEETS_READ', 'SHEETS_WRITE', 'DRIVE']:
+    setattr(hub_hq_utils, f'''{kind}_RATE''', 1000000)
+    setattr(hub_hq_utils, f'''{kind}_BURST''', 1000000)
+
+import everyaction_sync_portfolio as everyaction  # noqa: E402
+import mobilize_script_portfolio as mobilize  # noqa: E402
+
+HQ_HEADER = ['First Name', 'Last Name', 'Email', 'Phone', 'Date Joined', 'Total Sign Ups', 'Total Attendances',
+             'First Sign Up', 'First Attendance', 'Days Since Last Sign Up', 'Days Since Last Attendance', 'Status']
+
+
+class ApiStats:
+    """
+    Thread safe API call and byte counters, keyed by API name
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = defaultdict(int)
+        self.bytes = defaultdict(int)
+
+    def record(self, api: str, sent=None, received=None):
+        """
+        Count one call and the size of what was sent and received, measured as JSON
+        :param api: name of the API, e.g. 'sheets'
+        :param sent: request payload
+        :param received: response payload
+        :return: None
+        """
+        size = len(json.dumps(sent, default=str)) if sent is not None else 0
+        size += len(json.dumps(received, default=str)) if received is not None else 0
+        with self._lock:
+            self.calls[api] += 1
+            self.bytes[api] += size
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.calls), dict(self.bytes)
+
+
+def parse_a1(range_name: str):
+    """
+    Parse an A1 range like 'F4:L', 'C1:C' or 'A10:L20' (optionally prefixed with a worksheet name)
+    :param range_name: A1 notation range
+    :return: tuple of 0-based (first row, first column, last row or None, last column or None)
+    """
+    range_name = range_name.split('!')[-1]
+    cells = []
+    for cell in range_name.split(':'):
+        letters, digits = re.match(r'([A-Z]*)(\d*)', cell).groups()
+        column = 0
+        for letter in letters:
+            column = column * 26 + ord(letter) - 64
+        cells.append((int(digits) - 1 if digits else None, column - 1 if letters else None))
+    if len(cells) == 1:
+        cells.append(cells[0])
+    (first_row, first_column), (last_row, last_column) = cells
+    return first_row or 0, first_column or 0, last_row, last_column
+
+
+class FakeWorksheet:
+    """
+    gspread-like worksheet held in memory
+    """
+
+    def __init__(self, spreadsheet, title: str, rows: list, sheet_id: int = 0):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.id = sheet_id
+        self.rows = rows
+
+    @property
+    def row_count(self):
+        return len(self.rows)
+
+    def _touch(self):
+        self.spreadsheet.modified_time = datetime.datetime.utcnow().isoformat() + 'Z'
+
+    def _width(self):
+        return max([len(row) for row in self.rows] or [0])
+
+    def get_all_values(self):
+        width = self._width()
+        values = [[str(value) for value in row] + [''] * (width - len(row)) for row in self.rows]
+        self.spreadsheet.stats.record('sheets', received=values)
+        return values
+
+    def range_values(self, range_name: str):
+        first_row, first_column, last_row, last_column = parse_a1(range_name)
+        last_row = len(self.rows) - 1 if last_row is None else last_row
+        values = []
+        for row in self.rows[first_row:last_row + 1]:
+            row = [str(value) for value in row]
+            row = row[first_column:None if last_column is None else last_column + 1]
+            # Like the Sheets API, leave out trailing empty cells
+            while row and row[-1] == '':
+                row.pop()
+            values.append(row)
+        while values and not values[-1]:
+            values.pop()
+        return values
+
+    def write(self, first_row: int, first_column: int, values: list):
+        for row_offset, row_values in enumerate(values):
+            row_index = first_row + row_offset
+            while len(self.rows) <= row_index:
+                self.rows.append([])
+            row = self.rows[row_index]
+            for column_offset, value in enumerate(row_values):
+                column_index = first_column + column_offset
+                if len(row) <= column_index:
+                    row.extend([''] * (column_index + 1 - len(row)))
+                row[column_index] = '' if value is None else str(value)
+        self._touch()
+
+    def update(self, range_name: str, values: list):
+        first_row, first_column, _, _ = parse_a1(range_name)
+        self.write(first_row, first_column, values)
+        self.spreadsheet.stats.record('sheets', sent=values)
+
+    def batch_update(self, data: list, **kwargs):
+        for update in data:
+            first_row, first_column, _, _ = parse_a1(update['range'])
+            self.write(first_row, first_column, update['values'])
+        self.spreadsheet.stats.record('sheets', sent=data)
+
+    def append_rows(self, values: list, **kwargs):
+        self.write(len(self.rows), 0, values)
+        self.spreadsheet.stats.record('sheets', sent=values)
+
+
+class FakeSpreadsheet:
+    """
+    gspread-like spreadsheet held in memory
+    """
+
+    def __init__(self, spreadsheet_id: str, stats: ApiStats):
+        self.id = spreadsheet_id
+        self.stats = stats
+        self.modified_time = datetime.datetime.utcnow().isoformat() + 'Z'
+        self.worksheets = {}
+
+    def add_worksheet(self, title: str, rows: list):
+        self.worksheets[title] = FakeWorksheet(self, title, rows, sheet_id=len(self.worksheets))
+        return self.worksheets[title]
+
+    def worksheet(self, title: str):
+        self.stats.record('sheets')
+        return self.worksheets[title]
+
+    def batch_update(self, body: dict):
+        # updateCells and appendCells requests, applied in order like spreadsheets.batchUpdate
+        worksheets = {worksheet.id: worksheet for worksheet in self.worksheets.values()}
+        for request in body['requests']:
+            if 'updateCells' in request:
+                start = request['updateCells']['start']
+                worksheet, rows = worksheets[start['sheetId']], request['updateCells']['rows']
+                first_row, first_column = start['rowIndex'], start['columnIndex']
+            else:
+                worksheet, rows = worksheets[request['appendCells']['sheetId']], request['appendCells']['rows']
+                # Rows are appended after the last row with data
+                first_row = len(worksheet.rows)
+                while first_row and not any(worksheet.rows[first_row - 1]):
+                    first_row -= 1
+                first_column = 0
+            values = [[next(iter(cell.get('userEnteredValue', {'stringValue': ''}).values())) for cell in row['values']]
+                      for row in rows]
+            worksheet.write(first_row, first_column, values)
+        self.stats.record('sheets', sent=body)
+        return {'spreadsheetId': self.id, 'replies': [{} for _ in body['requests']]}
+
+    def values_get(self, range_name: str, **kwargs):
+        title = range_name.split('!')[0].strip("'")
+        values = self.worksheets[title].range_values(range_name)
+        self.stats.record('sheets', sent=range_name, received=values)
+        return {'range': range_name, 'values': values}
+
+
+class FakeResponse:
+    def __init__(self, payload):
+        self.payload = payload
+
+    def json(self):
+        return self.payload
+
+
+class FakeGspreadClient:
+    """
+    gspread-like client, including the Drive metadata request used for modified times
+    """
+
+    def __init__(self, stats: ApiStats):
+        self.stats = stats
+        self.spreadsheets = {}
+
+    def add_spreadsheet(self, spreadsheet_id: str):
+        self.spreadsheets[spreadsheet_id] = FakeSpreadsheet(spreadsheet_id, self.stats)
+        return self.spreadsheets[spreadsheet_id]
+
+    def open_by_key(self, spreadsheet_id: str):
+        self.stats.record('sheets')
+        return self.spreadsheets[spreadsheet_id]
+
+    def request(self, method: str, endpoint: str, params=None, **kwargs):
+        spreadsheet_id = endpoint.rstrip('/').split('/')[-1]
+        payload = {'modifiedTime': self.spreadsheets[spreadsheet_id].modified_time}
+        self.stats.record('drive', sent=params, received=payload)
+        return FakeResponse(payload)
+
+
+def redshift_to_sqlite(sql: str):
+    """
+    Rewrite the Redshift SQL the Mobilize script generates into SQLite's dialect, so the stand-in runs the script's own
+    statements instead of a copy of their logic. Covers what those statements use: ::date and ::text casts, day based
+    dateadd and datediff (see sql_dateadd and sql_datediff) and delete ... using
+    :param sql: Redshift SQL
+    :return: SQLite SQL
+    """
+    sql = re.sub(r'\b(dateadd|datediff)\(day,', r"\1('day',", sql)
+    sql = re.sub(r'((?:[\w.]+\([^()]*\))|[\w.]+)::date\b', r'date(\1)', sql)
+    sql = re.sub(r'((?:[\w.]+\([^()]*\))|[\w.]+)::text\b', r'cast(\1 as text)', sql)
+    return re.sub(r'delete from ([\w.]+)\s+using ([\w.]+)\s+where (.*?);',
+                  r'delete from \1 where exists (select 1 from \2 where \3);', sql, flags=re.S)
+
+
+def sql_getdate():
+    return datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def sql_dateadd(part: str, number: int, value):
+    if value is None:
+        return None
+    added = datetime.datetime.fromisoformat(str(value)) + datetime.timedelta(**{f'''{part}s''': number})
+    return added.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def sql_datediff(part: str, start, end):
+    # Redshift counts the day boundaries between the two, i.e. the difference between their dates
+    if start is None or end is None or part != 'day':
+        return None
+    return (datetime.date.fromisoformat(str(end)[:10]) - datetime.date.fromisoformat(str(start)[:10])).days
+
+
+class FakeRedshift:
+    """
+    rs.query / rs.copy stand-in backed by SQLite. Copied tables are stored as they are. The Mobilize script's queries
+    run as generated, through redshift_to_sqlite, against stand-ins for the sunrise_mobilize tables; other queries are
+    recognized by the tables they read and answered with SQLite equivalents of the Redshift SQL
+    """
+
+    def __init__(self, stats: ApiStats):
+        self.stats = stats
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(':memory:', check_same_thread=False)
+        # Varchar widths of the tables copy() and the checkpoints create, which SQLite doesn't enforce by itself
+        self.varchar_widths = {}
+        # Schemas the Mobilize script's SQL reads and writes. Its statements run as they are, through
+        # redshift_to_sqlite, against the raw Mobilize tables here
+        self.db.execute("attach database ':memory:' as sunrise")
+        self.db.execute("attach database ':memory:' as sunrise_mobilize")
+        self.db.executescript('''
+create table sunrise_mobilize.participations (
+    id integer primary key, event_id integer, user__email_address text, user__given_name text,
+    user__family_name text, user__phone_number text, created_date text, start_date text, attended boolean
+);
+create table sunrise_mobilize.events (id integer primary key, creator__email_address text);''')
+        self.db.create_function('getdate', 0, sql_getdate)
+        self.db.create_function('dateadd', 3, sql_dateadd)
+        self.db.create_function('datediff', 3, sql_datediff)
+
+    def add_participations(self, rows: list):
+        """
+        Add Mobilize participations, each with one event per hub email
+        :param rows: list of (id, hub email, email, first name, last name, phone, created date, start date, attended)
+        :return: None
+        """
+        with self._lock:
+            for hub_email in sorted({row[1] for row in rows}):
+                self.db.execute('insert into sunrise_mobilize.events (creator__email_address) select ? where not '
+                                'exists (select 1 from sunrise_mobilize.events where creator__email_address = ?)',
+                                (hub_email, hub_email))
+            event_ids = dict(self.db.execute('select creator__email_address, id from sunrise_mobilize.events'))
+            self.db.executemany('insert or replace into sunrise_mobilize.participations '
+                                'values (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                [(row[0], event_ids[row[1]]) + tuple(row[2:]) for row in rows])
+
+    def _table(self, sql: str, params=()):
+        cursor = self.db.execute(sql, params)
+        rows = cursor.fetchall()
+        if not rows:
+            return None
+        return Table([[column[0] for column in cursor.description]] + [list(row) for row in rows])
+
+    # Indexes on the tables the Mobilize script's SQL creates, standing in for Redshift's distribution and sort keys so
+    # SQLite's joins on them don't scan
+    MOBILIZE_INDEXES = {
+        mobilize.MOBILIZE_STATE_TABLE: ['participation_id', "hub_email, coalesce(lower(trim(email)), '')"],
+        mobilize.MOBILIZE_AGGREGATES_TABLE: ["hub_email, coalesce(lower(trim(email)), '')"],
+        'changed_participations': ['participation_id'],
+        'touched_keys': ["hub_email, coalesce(email, '')"],
+    }
+
+    def _mobilize_sql(self, sql: str):
+        # Run the Mobilize script's SQL statement by statement in one transaction, returning the last one's rows.
+        # Temp tables are dropped afterwards, like at the end of a Redshift session
+        result = None
+        statement = ''
+        try:
+            with self.db:
+                # The last statement doesn't need a semicolon
+                for line in redshift_to_sqlite(sql).rstrip().rstrip(';').splitlines(keepends=True) + [';']:
+                    statement += line
+                    if not sqlite3.complete_statement(statement):
+                        continue
+                    result = self._table(statement)
+                    created = re.search(r'^create (?:temp )?table (?:if not exists )?([\w.]+)', statement, flags=re.M)
+                    if created:
+                        name = created.group(1)
+                        schema, table = name.split('.') if '.' in name else ('temp', name)
+                        for number, columns in enumerate(self.MOBILIZE_INDEXES.get(name, [])):
+                            self.db.execute(f'''create index if not exists {schema}.{table}_{number} on {table} '''
+                                            f'''({columns})''')
+                    statement = ''
+        finally:
+            for (table,) in self.db.execute("select name from temp.sqlite_master where type = 'table'").fetchall():
+                self.db.execute(f'''drop table temp.{table}''')
+        return result
+
+    def _last_successful_syncs(self, sql: str):
+        try:
+            rows = self.db.execute(
+                'select hub, date_of_ea_sync_success from "sunrise.hq_ea_sync_control_table"').fetchall()
+        except sqlite3.OperationalError:
+            return Table([['hub', 'date']])
+        latest = {}
+        for hub, date_str in rows:
+            synced = datetime.datetime.strptime(date_str, '%m/%d/%Y %H:%M:%S')
+            latest[hub] = max(latest.get(hub, synced), synced)
+        return Table([['hub', 'date']] + [[hub, str(synced)] for hub, synced in latest.items()])
+
+    def _check_widths(self, table_name: str, columns: list, rows: list):
+        widths = self.varchar_widths.get(table_name, {})
+        for row in rows:
+            for column, value in zip(columns, row):
+                if value is not None and column in widths and len(str(value)) > widths[column]:
+                    raise ValueError(f'''value too long for type character varying({widths[column]}) in '''
+                                     f'''{table_name}.{column}''')
+
+    def _checkpoint_sync(self, sql: str, parameters: list):
+        # Same inserts as checkpoint_sync_sql, into tables laid out the way copy() creates them. Both run in one
+        # transaction, so an error row that doesn't fit leaves the control table as it was
+        error_values = parameters[2:]
+        error_rows = [error_values[i:i + 7] for i in range(0, len(error_values), 7)]
+        if error_rows:
+            self.varchar_widths.setdefault(everyaction.UPSERT_ERRORS_TABLE, {
+                'date': 256, 'hub': 256, 'first': 1024, 'last': 1024, 'email': 1024, 'error': 4096, 'traceback': 4096})
+            self._check_widths(everyaction.UPSERT_ERRORS_TABLE, everyaction.UPSERT_ERROR_COLUMNS, error_rows)
+        self.db.execute('create table if not exists "sunrise.hq_ea_sync_control_table" '
+                        '("hub", "date_of_ea_sync_success")')
+        self.db.execute('insert into "sunrise.hq_ea_sync_control_table" values (?, ?)', parameters[:2])
+        if error_rows:
+            self.db.execute(f'''create table if not exists "{everyaction.UPSERT_ERRORS_TABLE}" '''
+                            '("date", "hub", "first", "last", "email", "error", "traceback")')
+            self.db.executemany(f'''insert into "{everyaction.UPSERT_ERRORS_TABLE}" values (?, ?, ?, ?, ?, ?, ?)''',
+                                error_rows)
+        return None
+
+    def _upsert_cache(self, sql: str, parameters: list):
+        # Same statements as UpsertCache, against a SQLite table
+        self.db.execute('create table if not exists upsert_cache (committee text, email text, payload_hash text, '
+                        'van_id integer, upserted_at text)')
+        if sql.lstrip().startswith('insert'):
+            self.db.executemany("insert into upsert_cache values (?, ?, ?, ?, strftime('%Y-%m-%d %H:%M:%f', 'now'))",
+                                [parameters[i:i + 4] for i in range(0, len(parameters), 4)])
+        elif 'select' in sql:
+            # Later rows win, like the newest upserted_at
+            return self._table('select email, payload_hash from upsert_cache where rowid in '
+                               '(select max(rowid) from upsert_cache where committee = ? group by email)', parameters)
+        return None
+
+    def _sync_state(self, sql: str, parameters: list):
+        # Same statements as HubSyncState, against a SQLite table
+        self.db.execute('create table if not exists sync_state (script text, spreadsheet_id text, modified_time text, '
+                        'activity text, synced_at text)')
+        if sql.lstrip().startswith('insert'):
+            self.db.execute("insert into sync_state values (?, ?, ?, ?, datetime('now'))", parameters)
+        elif 'select' in sql:
+            # Later rows win, like the newest synced_at
+            return self._table('select spreadsheet_id, modified_time, activity, date(synced_at) as synced_on '
+                               'from sync_state where rowid in '
+                               '(select max(rowid) from sync_state where script = ? group by spreadsheet_id)',
+                               parameters)
+        return None
+
+    def query(self, sql: str, parameters=None):
+        with self._lock:
+            if hub_hq_utils.UPSERT_CACHE_TABLE in sql:
+                result = self._upsert_cache(sql, parameters)
+            elif hub_hq_utils.HUB_SYNC_STATE_TABLE in sql:
+                result = self._sync_state(sql, parameters)
+            elif 'sunrise_mobilize.' in sql or 'sunrise.hub_hq_mobilize_' in sql:
+                result = self._mobilize_sql(sql)
+            elif 'insert into sunrise.hq_ea_sync_control_table' in sql:
+                result = self._checkpoint_sync(sql, parameters)
+            elif 'sunrise.hq_ea_sync_control_table' in sql:
+                result = self._last_successful_syncs(sql)
+            else:
+                raise ValueError(f'''No stand-in for query: {sql[:200]}''')
+        self.stats.record('redshift', sent=sql, received=None if result is None else [list(row) for row in result.data])
+        return result
+
+    @contextmanager
+    def connection(self):
+        yield FakeConnection(self)
+
+    def table_exists(self, table_name: str):
+        with self._lock:
+            exists = self.db.execute("select 1 from sqlite_master where type = 'table' and name = ?",
+                                     [table_name]).fetchone() is not None
+        self.stats.record('redshift', sent=table_name)
+        return exists
+
+    def alter_varchar_column_widths(self, tbl, table_name: str):
+        # Like parsons: widen the table's varchar columns that are narrower than tbl's values, to tbl's widths
+        with self._lock:
+            widths = self.varchar_widths.get(table_name, {})
+            for column in tbl.columns:
+                width = max((len(str(value)) for value in tbl.column_data(column) if value is not None), default=0)
+                if column in widths and widths[column] < width:
+                    widths[column] = width
+        self.stats.record('redshift', sent=table_name)
+
+    def copy(self, tbl, table_name: str, if_exists: str = 'fail', alter_table: bool = False, **kwargs):
+        if tbl.num_rows == 0:
+            raise ValueError('Table has no rows')
+        columns = ', '.join(f'"{column}"' for column in tbl.columns)
+        placeholders = ', '.join('?' for _ in tbl.columns)
+        rows = [[None if value is None else str(value) for value in row] for row in tbl.data]
+        widths = {column: max((len(value) for value in values if value is not None), default=0)
+                  for column, values in zip(tbl.columns, zip(*rows))}
+        with self._lock:
+            if if_exists == 'drop':
+                self.db.execute(f'drop table if exists "{table_name}"')
+                self.varchar_widths.pop(table_name, None)
+            if table_name not in self.varchar_widths:
+                # New tables get parsons' varchar steps (constants.VARCHAR_STEPS) for the widest value in each column
+                steps = [32, 64, 128, 256, 512, 1024, 4096, 8192, 16384]
+                self.varchar_widths[table_name] = {
+                    column: next((step for step in steps if step >= width), 65535) for column, width in widths.items()}
+            elif alter_table:
+                table_widths = self.varchar_widths[table_name]
+                for column, width in widths.items():
+                    table_widths[column] = max(table_widths.get(column, 0), width)
+            self._check_widths(table_name, tbl.columns, rows)
+            self.db.execute(f'create table if not exists "{table_name}" ({columns})')
+            self.db.executemany(f'insert into "{table_name}" ({columns}) values ({placeholders})', rows)
+        self.stats.record('redshift', sent=rows)
+
+
+class FakeCursor:
+    """
+    psycopg2-like named (server-side) cursor for the Mobilize aggregates query, fetching itersize rows at a time
+    """
+
+    def __init__(self, rs: FakeRedshift):
+        self.rs = rs
+        self.itersize = 2000
+        self.description = None
+        self._cursor = None
+
+    def execute(self, sql: str):
+        if mobilize.MOBILIZE_AGGREGATES_TABLE not in sql:
+            raise ValueError(f'''No stand-in for streamed query: {sql[:200]}''')
+        with self.rs._lock:
+            self._cursor = self.rs.db.cursor()
+            self._cursor.execute(redshift_to_sqlite(sql))
+        self.rs.stats.record('redshift', sent=sql)
+
+    def __iter__(self):
+        while True:
+            with self.rs._lock:
+                rows = self._cursor.fetchmany(self.itersize)
+                self.description = self._cursor.description
+            if not rows:
+                return
+            self.rs.stats.record('redshift', received=rows)
+            yield from rows
+
+    def close(self):
+        self._cursor.close()
+
+
+class FakeConnection:
+    def __init__(self, rs: FakeRedshift):
+        self.rs = rs
+
+    def cursor(self, name: str = None):
+        return FakeCursor(self.rs)
+
+
+class FakeVAN:
+    """
+    VAN upsert stub with configurable latency and rate of 429 responses
+    """
+
+    def __init__(self, stats: ApiStats, latency: float = 0.0, rate_429: float = 0.0, seed: int = 0):
+        self.stats = stats
+        self.latency = latency
+        self.rate_429 = rate_429
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._van_ids = {}
+
+    def upsert_person_json(self, payload: dict):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            throttled = self._random.random() < self.rate_429
+            email = payload['emails'][0]['email']
+            van_id = self._van_ids.setdefault(email, len(self._van_ids) + 1)
+        if throttled:
+            self.stats.record('van', sent=payload)
+            # Raise what parsons raises for a 429: an HTTPError with the status code in its message, chained from
+            # requests' HTTPError that carries the response
+            response = requests.Response()
+            response.status_code = 429
+            response.url = 'https://api.securevan.com/v4/people/findOrCreate'
+            response.reason = 'Too Many Requests'
+            APIConnector('https://api.securevan.com/v4/').validate_response(response)
+        response = {'vanId': van_id, 'status': 'UnmatchedStored'}
+        self.stats.record('van', sent=payload, received=response)
+        return response
+
+
+def synthetic_date(base: datetime.datetime, rng: random.Random, max_days: int):
+    return base - datetime.timedelta(seconds=rng.randint(0, max_days * 86400))
+
+
+def build_environment(rows: int, hubs: int, args, seed: int = 0):
+    """
+    Create stand-in clients with synthetic hubs and point the scripts' client registry at them
+    :param rows: HQ rows per hub
+    :param hubs: number of hubs
+    :param args: parsed command line arguments
+    :param seed: random seed
+    :return: tuple of (ApiStats, FakeGspreadClient, FakeRedshift, list of hub dictionaries, watermark per hub name)
+    """
+    rng = random.Random(seed)
+    stats = ApiStats()
+    gspread_client = FakeGspreadClient(stats)
+    rs = FakeRedshift(stats)
+    now = datetime.datetime.utcnow()
+    cron_job = [['hub_name', 'hub_email', 'spreadsheet_id']]
+    api_keys = {}
+    watermarks = {}
+    participation_id = 0
+    for hub_number in range(hubs):
+        hub_name = f'Hub {hub_number}'
+        hub_email = f'hub{hub_number}@example.org'
+        spreadsheet_id = f'spreadsheet-{hub_number}'
+        cron_job.append([hub_name, hub_email, spreadsheet_id])
+        api_keys[hub_name] = f'key-{hub_number}'
+
+        # HQ rows, oldest first. Row 1-2 are instructions and row 3 is the header
+        hq_rows = [['Instructions'], ['Tips'], HQ_HEADER[:]]
+        dates_joined = sorted(synthetic_date(now, rng, 720) for _ in range(rows))
+        participations = []
+        for row_number, date_joined in enumerate(dates_joined):
+            email = f'person{row_number}@hub{hub_number}.org'
+            hq_rows.append([f'First{row_number}', f'Last{row_number}', email, f'555{row_number:07d}',
+                            date_joined.strftime('%Y-%m-%d %H:%M:%S')] + [''] * 7)
+            # Most HQ contacts have Mobilize sign ups
+            if rng.random() < args.mobilize_match_rate:
+                for _ in range(rng.randint(1, 5)):
+                    participation_id += 1
+                    start_date = synthetic_date(now, rng, 365)
+                    # Some sign ups use a different case or stray whitespace for the same email
+                    signup_email = email if rng.random() < 0.9 else f''' {email.upper()} '''
+                    participations.append((participation_id, hub_email, signup_email, f'First{row_number}',
+                                           f'Last{row_number}', f'555{row_number:07d}',
+                                           date_joined.strftime('%Y-%m-%d %H:%M:%S'),
+                                           start_date.strftime('%Y-%m-%d %H:%M:%S'), rng.random() < 0.6))
+        # Contacts who signed up on Mobilize but aren't in the HQ yet
+        for new_number in range(int(rows * args.mobilize_new_rate)):
+            participation_id += 1
+            created_date = synthetic_date(now, rng, 2)
+            participations.append((participation_id, hub_email, f'new{new_number}@hub{hub_number}.org',
+                                   f'New{new_number}', 'Person', '', created_date.strftime('%Y-%m-%d %H:%M:%S'),
+                                   created_date.strftime('%Y-%m-%d %H:%M:%S'), False))
+        rs.add_participations(participations)
+        gspread_client.add_spreadsheet(spreadsheet_id).add_worksheet('Hidden HQ', hq_rows)
+
+        # Last EveryAction sync happened before the newest share of contacts joined
+        if dates_joined and args.new_contact_rate < 1:
+            cutoff = dates_joined[int(len(dates_joined) * (1 - args.new_contact_rate)) - 1]
+            watermarks[hub_name] = cutoff
+    gspread_client.add_spreadsheet(hub_hq_utils.CRON_JOB_SPREADSHEET_ID).add_worksheet('cron job', cron_job)
+    if watermarks:
+        rs.copy(Table([['hub', 'date_of_ea_sync_success']] +
+                      [[hub_name, cutoff.strftime('%m/%d/%Y %H:%M:%S')] for hub_name, cutoff in watermarks.items()]),
+                'sunrise.hq_ea_sync_control_table', if_exists='append')
+
+    cache_dir = tempfile.mkdtemp()
+    clients.set(rs=rs, gspread_client=gspread_client, api_keys=api_keys,
+                snapshot_store=HQSnapshotStore(os.path.join(cache_dir, 'hub_hq_snapshots.sqlite')),
+                upsert_cache=UpsertCache(rs), sync_state=HubSyncState(rs))
+    for hub_number, api_key in enumerate(api_keys.values()):
+        clients.set_van(api_key, FakeVAN(stats, args.van_latency, args.van_429_rate, seed=seed + hub_number))
+    hub_list = [dict(zip(cron_job[0], hub)) for hub in cron_job[1:]]
+    stats.calls.clear()
+    stats.bytes.clear()
+    return stats, gspread_client, rs, hub_list, watermarks
+
+
+class Report:
+    """
+    Collects per stage results and prints them as a table
+    """
+
+    def __init__(self):
+        self.results = []
+
+    def measure(self, stats: ApiStats, rows: int, stage: str, function, *args, **kwargs):
+        """
+        Run a stage and record its wall time, throughput, API calls and bytes
+        :param stats: ApiStats the stand-ins record to
+        :param rows: number of rows the stage handles, for rows/sec
+        :param stage: stage name
+        :param function: function to run
+        :return: whatever the function returns
+        """
+        calls_before, bytes_before = stats.snapshot()
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        wall = time.perf_counter() - start
+        calls_after, bytes_after = stats.snapshot()
+        calls = {api: calls_after[api] - calls_before.get(api, 0) for api in calls_after
+                 if calls_after[api] != calls_before.get(api, 0)}
+        transferred = sum(bytes_after.values()) - sum(bytes_before.values())
+        self.results.append({'stage': stage, 'rows': rows, 'wall_seconds': wall,
+                             'rows_per_second': rows / wall if wall else None, 'api_calls': calls,
+                             'bytes': transferred})
+        return result
+
+    def print(self):
+        print(f'''{'stage':<40} {'rows':>8} {'wall s':>9} {'rows/s':>11} {'bytes':>12}  api calls''')
+        for result in self.results:
+            calls = ', '.join(f'{api}={count}' for api, count in sorted(result['api_calls'].items()))
+            rows_per_second = f'''{result['rows_per_second']:,.0f}''' if result['rows_per_second'] else '-'
+            print(f'''{result['stage']:<40} {result['rows']:>8} {result['wall_seconds']:>9.3f} '''
+                  f'''{rows_per_second:>11} {result['bytes']:>12,}  {calls}''')
+
+
+def check_mobilize_paths(rows: int, args):
+    """
+    Run the Mobilize updates and appends for one synthetic hub through the full rewrite, diff write and windowed paths,
+    starting from the same Hidden HQ each time, and check that they leave the sheet in the same state
+    :param rows: HQ rows in the hub
+    :param args: parsed command line arguments
+    :return: None. Raises RuntimeError if the paths disagree
+    """
+    _, gspread_client, _, hubs, _ = build_environment(rows, 1, args)
+    hub = hubs[0]
+    worksheet = gspread_client.spreadsheets[hub['spreadsheet_id']].worksheets['Hidden HQ']
+    original_rows = [row[:] for row in worksheet.rows]
+    sheets = {}
+    for path in ['full', 'diff', 'windowed']:
+        worksheet.rows = [row[:] for row in original_rows]
+        hidden_hq_worksheet = mobilize.connect_to_hq(hub)
+        mobilize_dict = mobilize.get_mobilize_data(hub, mobilize.get_all_mobilize_data(hubs,
+                                                                                       streaming=path == 'windowed'))
+        if path == 'windowed':
+            mobilize.mobilize_updates_windowed(hub, mobilize_dict, hidden_hq_worksheet, mobilize.hidden_hq_columns)
+        else:
+            hidden_hq = worksheet.get_all_values()[3:]
+            mobilize_parsons_append = mobilize.mobilize_updates(hub, mobilize_dict, hidden_hq, hidden_hq_worksheet,
+                                                                mobilize.hidden_hq_columns,
+                                                                diff_writes=path == 'diff')
+            writes = SheetWriteBatch(hidden_hq_worksheet)
+            writes.append_rows([list(row) for row in mobilize_parsons_append.data])
+            writes.flush()
+        sheets[path] = worksheet.get_all_values()
+    for path in ['diff', 'windowed']:
+        if sheets[path] != sheets['full']:
+            row_number = next((i + 1 for i, (row, full_row) in enumerate(zip(sheets[path], sheets['full']))
+                               if row != full_row), min(len(sheets[path]), len(sheets['full'])) + 1)
+            raise RuntimeError(f'''Mobilize {path} path left a different Hidden HQ than the full path, starting at '''
+                               f'''row {row_number} ({len(sheets[path])} rows vs {len(sheets['full'])})''')
+    print(f'''mobilize: full, diff and windowed paths leave the same Hidden HQ ({len(sheets['full'])} rows)''')
+
+
+def check_attendance_state(rows: int, args):
+    """
+    Fold new sign ups, attendance marked after events and a changed sign up email into the Mobilize attendance state
+    with refresh_attendance_state_sql, and check that the hub's event attendance comes out the same as after a full
+    rebuild from the participations
+    :param rows: HQ rows in the hub
+    :param args: parsed command line arguments
+    :return: None. Raises RuntimeError if the incremental state disagrees with the rebuild
+    """
+    _, _, rs, hubs, _ = build_environment(rows, 1, args)
+    hub_email = hubs[0]['hub_email']
+    mobilize.get_all_mobilize_data(hubs, streaming=False)
+    now = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    with rs._lock:
+        # Backdate the last rebuild, still inside MOBILIZE_FULL_REFRESH_DAYS, to tell whether the next refresh rebuilt
+        rs.db.execute(f'''update {mobilize.MOBILIZE_WATERMARKS_TABLE} set refreshed_at = datetime('now', '-1 day')''')
+        recent = rs.db.execute(
+            "select id, user__email_address, start_date >= datetime('now', '-20 days') "
+            "from sunrise_mobilize.participations where start_date >= datetime('now', '-40 days') "
+            "or created_date >= datetime('now', '-40 days') order by id").fetchall()
+        participation_id = rs.db.execute('select max(id) from sunrise_mobilize.participations').fetchone()[0]
+        emails = [row[0] for row in rs.db.execute(
+            'select distinct lower(trim(user__email_address)) from sunrise_mobilize.participations order by 1'
+        ).fetchall()]
+        signup_emails = emails[:max(1, rows // 10)]
+        # Attendance marked (or unmarked) after the event
+        updated = [i for i, _, in_lookback in recent if in_lookback][::2]
+        for i in updated:
+            rs.db.execute('update sunrise_mobilize.participations set attended = 1 - attended where id = ?', [i])
+        # A sign up moved to another email. It's the only recent sign up of its old email, so only the state can
+        # tell that the old email's aggregates change
+        recent_emails = Counter(email.strip().lower() for _, email, _ in recent)
+        moved = [i for i, email, in_lookback in recent if in_lookback and recent_emails[email.strip().lower()] == 1
+                 and email.strip().lower() not in signup_emails][-1:]
+        for i in moved:
+            rs.db.execute("update sunrise_mobilize.participations set user__email_address = 'moved@example.org' "
+                          "where id = ?", [i])
+    # New sign ups from existing contacts, some with a different case or stray whitespace, and from new contacts
+    new_rows = []
+    for number, email in enumerate(signup_emails + [f'''late{i}@example.org''' for i in range(max(1, rows // 50))]):
+        participation_id += 1
+        new_rows.append((participation_id, hub_email, f''' {email.upper()}''' if number % 3 == 0 else email,
+                         f'''Late{number}''', 'Person', '', now, now, number % 2 == 0))
+    rs.add_participations(new_rows)
+    incremental = mobilize.get_all_mobilize_data(hubs, streaming=False).get(hub_email, {})
+    with rs._lock:
+        rebuilt_since = rs.db.execute(f'''select count(*) from {mobilize.MOBILIZE_WATERMARKS_TABLE} '''
+                                      "where refreshed_at > datetime('now', '-1 hour')").fetchone()[0]
+        # Without watermarks every hub is rebuilt from its full history
+        rs.db.execute(f'''delete from {mobilize.MOBILIZE_WATERMARKS_TABLE}''')
+    if rebuilt_since:
+        raise RuntimeError('Mobilize attendance state was rebuilt instead of refreshed incrementally')
+    rebuilt = mobilize.get_all_mobilize_data(hubs, streaming=False).get(hub_email, {})
+    different = sorted(email for email in set(incremental) | set(rebuilt)
+                       if incremental.get(email) != rebuilt.get(email))
+    if different:
+        raise RuntimeError(f'''Incremental Mobilize attendance state differs from a full rebuild for '''
+                           f'''{len(different)} contacts, e.g. {different[:3]}''')
+    print(f'''mobilize: incremental attendance state matches a full rebuild ({len(rebuilt)} contacts, '''
+          f'''{len(new_rows)} new sign ups, {len(updated)} attendance updates, {len(moved)} moved sign ups)''')
+
+
+def check_snapshots(hubs: list):
+    """
+    Check that every Hidden HQ snapshot marked as current matches what's in the sheet
+    :param hubs: hubs the scripts ran for
+    :return: None. Raises RuntimeError if a snapshot is out of date
+    """
+    for hub in hubs:
+        snapshot = clients.snapshot_store.load(hub['spreadsheet_id'])
+        hidden_hq_worksheet = mobilize.connect_to_hq(hub)
+        if snapshot is not None and snapshot['modified_time'] == hidden_hq_worksheet.modified_time() \
+                and snapshot['rows'] != hidden_hq_worksheet.get_all_values():
+            raise RuntimeError(f'''Snapshot for {hub['hub_name']} doesn't match its Hidden HQ''')
+
+
+def benchmark_mobilize(report: Report, rows: int, args):
+    check_mobilize_paths(rows, args)
+    check_attendance_state(rows, args)
+    stats, gspread_client, rs, hubs, _ = build_environment(rows, 1, args)
+    hub = hubs[0]
+    report.measure(stats, rows, 'mobilize: redshift query (rebuild)', mobilize.get_all_mobilize_data, hubs)
+    # The attendance state is now up to date, so only the newest participations are folded in
+    all_mobilize_dicts = report.measure(stats, rows, 'mobilize: redshift query (incremental)',
+                                        mobilize.get_all_mobilize_data, hubs)
+    hidden_hq_worksheet = mobilize.connect_to_hq(hub)
+    hq_snapshot = report.measure(stats, rows, 'mobilize: sheet read (cold)', read_hidden_hq, hidden_hq_worksheet,
+                                 clients.snapshot_store)
+    report.measure(stats, rows, 'mobilize: sheet read (snapshot)', read_hidden_hq, hidden_hq_worksheet,
+                   clients.snapshot_store)
+    hidden_hq = [row[:] for row in hq_snapshot[3:]]
+    report.measure(stats, rows, 'mobilize: compute + sheet write', mobilize.mobilize_updates, hub,
+                   mobilize.get_mobilize_data(hub, all_mobilize_dicts), hidden_hq, hidden_hq_worksheet,
+                   mobilize.hidden_hq_columns)
+
+    # Streaming mode for the same hub: Mobilize rows streamed into a MobilizeRows store and the HQ handled in windows
+    stats, _, _, hubs, _ = build_environment(rows, 1, args)
+    all_mobilize_rows = report.measure(stats, rows, 'mobilize: redshift query (streamed)',
+                                       mobilize.get_all_mobilize_data, hubs, streaming=True)
+    report.measure(stats, rows, 'mobilize: windowed compute + sheet write', mobilize.mobilize_updates_windowed,
+                   hubs[0], mobilize.get_mobilize_data(hubs[0], all_mobilize_rows), mobilize.connect_to_hq(hubs[0]),
+                   mobilize.hidden_hq_columns)
+
+    stats, _, rs, hubs, _ = build_environment(rows, args.hubs, args)
+    report.measure(stats, rows * args.hubs, f'''mobilize: main ({args.hubs} hubs)''', mobilize.main)
+    check_snapshots(hubs)
+    report.measure(stats, rows * args.hubs, f'''mobilize: main rerun ({args.hubs} hubs)''', mobilize.main)
+    # Nothing changed since the last sync, so the next day's run only refreshes the day based fields
+    rs.db.execute("update sync_state set synced_at = '2000-01-01 00:00:00'")
+    # A new run reads the sync state again
+    clients.set(sync_state=HubSyncState(rs))
+    report.measure(stats, rows * args.hubs, f'''mobilize: main next day ({args.hubs} hubs)''', mobilize.main)
+    # Without HQ_SNAPSHOT_PATH every sheet is read in full
+    stats, _, _, hubs, _ = build_environment(rows, args.hubs, args)
+    clients.set(snapshot_store=None)
+    report.measure(stats, rows * args.hubs, f'''mobilize: main, no snapshots ({args.hubs} hubs)''', mobilize.main)
+
+
+def benchmark_everyaction(report: Report, rows: int, args):
+    stats, _, _, hubs, watermarks = build_environment(rows, 1, args)
+    hub = hubs[0]
+    hq = report.measure(stats, rows, 'everyaction: get_hq (cold)', everyaction.get_hq, hub['spreadsheet_id'])
+    report.measure(stats, rows, 'everyaction: get_hq (snapshot)', everyaction.get_hq, hub['spreadsheet_id'])
+    clients.set(snapshot_store=None)
+    report.measure(stats, rows, 'everyaction: get_hq (no snapshots)', everyaction.get_hq, hub['spreadsheet_id'])
+    new_contacts = max(1, int(rows * args.new_contact_rate))
+    new_hq_contacts = Table([list(hq.columns)] + [list(row) for row in hq.data][-new_contacts:])
+    api_key = clients.api_keys[hub['hub_name']]
+    upsert_errors = []
+    report.measure(stats, new_hq_contacts.num_rows, 'everyaction: subscribe_to_ea', everyaction.subscribe_to_ea,
+                   clients.van(api_key), new_hq_contacts, hub, upsert_errors, api_key)
+    # Resending the same contacts (e.g. a rerun after a failure) is answered from the upsert cache
+    report.measure(stats, new_hq_contacts.num_rows, 'everyaction: subscribe_to_ea (cached)',
+                   everyaction.subscribe_to_ea, clients.van(api_key), new_hq_contacts, hub, upsert_errors, api_key)
+
+    stats, gspread_client, _, hubs, _ = build_environment(rows, args.hubs, args)
+    report.measure(stats, rows * args.hubs, f'''everyaction: main ({args.hubs} hubs)''', everyaction.main)
+    # Each hub's watermark was checkpointed, so a rerun has nothing left to upsert
+    report.measure(stats, rows * args.hubs, f'''everyaction: main rerun ({args.hubs} hubs)''', everyaction.main)
+    # The Mobilize script's daily writes change every sheet's modified time but not its Date Joined column, so hubs
+    # are still skipped
+    for hub in hubs:
+        gspread_client.spreadsheets[hub['spreadsheet_id']].worksheets['Hidden HQ']._touch()
+    calls_before = stats.snapshot()[0].get('van', 0)
+    report.measure(stats, rows * args.hubs, f'''everyaction: main, HQs touched ({args.hubs} hubs)''',
+                   everyaction.main)
+    if stats.snapshot()[0].get('van', 0) != calls_before:
+        raise RuntimeError('EveryAction sync upserted contacts after only the sheets\' modified times changed')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Hub HQ sync scripts against local stand-ins')
+    parser.add_argument('--rows', type=int, nargs='+', default=[100, 1000, 10000, 100000],
+                        help='HQ rows per hub, one benchmark per value')
+    parser.add_argument('--hubs', type=int, default=2, help='hubs for the main() benchmarks')
+    parser.add_argument('--van-latency', type=float, default=0.0, help='seconds each VAN upsert takes')
+    parser.add_argument('--van-429-rate', type=float, default=0.0, help='share of VAN upserts that get a 429')
+    parser.add_argument('--van-rate', type=float, default=1000000, help='VAN upserts per second per API key')
+    parser.add_argument('--new-contact-rate', type=float, default=0.1,
+                        help='share of HQ contacts added since the last EveryAction sync')
+    parser.add_argument('--mobilize-match-rate', type=float, default=0.8,
+                        help='share of HQ contacts with Mobilize sign ups')
+    parser.add_argument('--mobilize-new-rate', type=float, default=0.02,
+                        help='new Mobilize contacts per HQ row that are not in the HQ yet')
+    parser.add_argument('--streaming-threshold', type=int, default=mobilize.STREAMING_ROW_THRESHOLD,
+                        help='Mobilize contacts or HQ rows per hub at which main() switches to streaming mode')
+    parser.add_argument('--scripts', nargs='+', default=['mobilize', 'everyaction'],
+                        choices=['mobilize', 'everyaction'], help='which scripts to benchmark')
+    parser.add_argument('--json', help='also write the results to this JSON file')
+    args = parser.parse_args()
+
+    # Keep rate limits and retries from dominating the numbers unless asked for
+    everyaction.UPSERT_RATE = args.van_rate
+    everyaction.UPSERT_BURST = max(1, int(args.van_rate))
+    everyaction.UPSERT_BACKOFF = 0.01
+    mobilize.STREAMING_ROW_THRESHOLD = args.streaming_threshold
+    mobilize.logger.setLevel('WARNING')
+    everyaction.logger.setLevel('WARNING')
+
+    report = Report()
+    for rows in args.rows:
+        if 'mobilize' in args.scripts:
+            benchmark_mobilize(report, rows, args)
+        if 'everyaction' in args.scripts:
+            benchmark_everyaction(report, rows, args)
+    report.print()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report.results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,16 +6,18 @@
 # errors are logged in Sunrise.hub_hq_errors
 
 
-import json
+import re
 import time
-from parsons import GoogleSheets, Redshift, Table, VAN
-import gspread
-from googleapiclient.errors import HttpError
-from oauth2client.service_account import ServiceAccountCredentials
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from parsons import Table
 import logging
-from datetime import timezone, timedelta
+from datetime import date
 import datetime
-import os
+import traceback
+from functools import partial
+import numpy as np
+from hub_hq_utils import (HiddenHQ, clients, committee_key, get_hubs, get_rate_limiter, key_checksum, metrics,
+                          normalize_email, parse_hq_dates, payload_hash, read_hidden_hq, run_hubs, start_metrics)
 
 
 # Set up logger
@@ -26,70 +28,153 @@ _handler.setFormatter(_formatter)
 logger.addHandler(_handler)
 logger.setLevel('INFO')
 
-# Set environ using civis credentials from container script
-os.environ['REDSHIFT_DB'] = os.environ['REDSHIFT_DATABASE']
-os.environ['REDSHIFT_USERNAME'] = os.environ['REDSHIFT_CREDENTIAL_USERNAME']
-os.environ['REDSHIFT_PASSWORD'] = os.environ['REDSHIFT_CREDENTIAL_PASSWORD']
-os.environ['S3_TEMP_BUCKET'] = 'parsons-tmc'
+# EveryAction upsert settings. Rate limits are per API key (i.e. per committee), so hubs with different keys don't
+# slow each other down
+UPSERT_WORKERS = 4  # concurrent upsert requests per hub
+UPSERT_RATE = 5  # upserts per second per API key
+UPSERT_BURST = 5  # upserts that can be sent at once after the key has been idle
+UPSERT_MAX_RETRIES = 5  # retries for rate limited (429) and server (5xx) errors
+UPSERT_BACKOFF = 1  # seconds to wait before the first retry, doubled on each retry after that
+CHECKPOINT_BATCH_SIZE = 500  # contacts upserted between each write of the hub's watermark to the control table
+DATE_JOINED_RANGE = 'E4:E'  # Date Joined column of the Hidden HQ, below the header
+UPSERT_ERRORS_TABLE = 'sunrise.hq_ea_sync_errors'
+UPSERT_ERROR_COLUMNS = ['date', 'hub', 'first', 'last', 'email', 'error', 'traceback']
 
-# Load redshift and VAN credentials
-rs = Redshift()
-api_keys = json.loads(os.environ['EVERYACTION_KEYS_PASSWORD'])
 
-# Load google credentials for parsons
-creds = json.loads(os.environ['GOOGLE_JSON_CRED_PASSWORD'])  # Load JSON credentials
-parsons_sheets = GoogleSheets(google_keyfile_dict=creds)  # Initiate parsons GSheets class
-
-# Set up google sheets connection for gspread package
-scope = [
-    'https://spreadsheets.google.com/feeds',
-    'https://www.googleapis.com/auth/drive',
-]
-credentials = ServiceAccountCredentials.from_json_keyfile_dict(creds, scope)
-gspread_client = gspread.authorize(credentials)
-
-
-
-
-def get_hq(spreadsheet_id: str):
+def get_hq(spreadsheet_id: str, modified_time: str = None):
     """
-    Get all records from hub's HQ
+    Get all records from hub's HQ. With a snapshot store, the sheet is only downloaded if it changed since the last
+    snapshot
     :param spreadsheet_id: spreadsheet ID for the hub's HQ
+    :param modified_time: the sheet's Drive modified time, if the caller already has it
     :return: Parson's table of all of the records
     """
     # Connect to the hq with gspread
-    hq = gspread_client.open_by_key(spreadsheet_id)
-    # Connect to the set up worksheet via gspread
-    hq_worksheet = hq.worksheet('Hidden HQ')
-    hq_lists = hq_worksheet.get_all_values()
+    hq_worksheet = HiddenHQ(clients.gspread_client, spreadsheet_id)
+    hq_lists = read_hidden_hq(hq_worksheet, clients.snapshot_store, modified_time)
     hq_table = Table(hq_lists[2:])
     return hq_table
 
-def subscribe_to_ea():
+
+def date_joined_signature(hidden_hq: HiddenHQ):
     """
-    Upsert (i.e. findOrCreate) new HQ contacts into hub's EveryAction committee
-    :return: None
+    Summarize a Hidden HQ's Date Joined column. Contacts are only ever added to the HQ, each with a Date Joined, so the
+    summary only changes when there may be contacts to sync. The sheet's modified time can't tell this, since the
+    Mobilize script writes to every HQ each day
+    :param hidden_hq: HiddenHQ handle for the hub's sheet
+    :return: string of the number of Date Joined values and their checksum
+    """
+    values = [row[0] if row else '' for row in hidden_hq.values(DATE_JOINED_RANGE)]
+    return f'''{len(values)}|{key_checksum(values)}'''
+
+
+def select_rows_by_mask(tbl, mask):
+    """
+    Subset a parsons table with a boolean mask instead of a per-row function
+    :param tbl: parsons table
+    :param mask: list or numpy array of booleans, one per row
+    :return: parsons table of the rows where the mask is True
+    """
+    return Table([list(tbl.columns)] + [list(row) for row, keep in zip(tbl.data, mask) if keep])
+
+
+def upsert_status_code(e: Exception):
+    """
+    Get the HTTP status code from an upsert error
+    :param e: exception raised by van.upsert_person_json
+    :return: status code as an int, or None if the error wasn't an HTTP error
     """
-    # Try
-    for contact in new_hq_contacts:
-        json = {
-      'firstName': contact['First Name'],
-      "lastName": contact['Last Name'],
-      "emails":
-            [{"email": contact['Email'],
-            "isSubscribed":'true'}]
-        }
-        #Except (need to figure out what kind of errors I'll get here)
+    # Parsons raises a new HTTPError without the response attached, from the one requests raised with it
+    for error in [e, e.__cause__]:
+        response = getattr(error, 'response', None)
+        if response is not None:
+            return response.status_code
+    # Otherwise the status code is only in the message: "Code: 429; URL: ..." in current parsons versions, "HTTP error
+    # occurred (429)" in older ones
+    match = re.search(r'^Code: (\d{3});|HTTP error occurred \((\d{3})\)', str(e))
+    if match:
+        return int(match.group(1) or match.group(2))
+    return None
+
+
+def upsert_contact(van, payload: dict, rate_limiter, hub_name: str = None):
+    """
+    Upsert one contact, waiting for the API key's rate limiter and retrying with exponential backoff when EveryAction
+    responds with a 429 or 5xx error
+    :param van: parsons VAN object for the hub's committee
+    :param payload: json for van.upsert_person_json
+    :param rate_limiter: RateLimiter shared by every upsert that uses the same API key
+    :param hub_name: hub to count the API calls and retries against in the run's metrics
+    :return: response from van.upsert_person_json
+    """
+    backoff = UPSERT_BACKOFF
+    for attempt in range(UPSERT_MAX_RETRIES + 1):
+        rate_limiter.acquire()
+        metrics.add('ea_upsert', hub_name, api_calls=1, retries=1 if attempt else 0)
         try:
-            van.upsert_person_json(json)
-            time.sleep(.5)
+            return van.upsert_person_json(payload)
         except Exception as e:
-            response = str(e)
-            exceptiondata = traceback.format_exc().splitlines()
-            exception = exceptiondata[len(exceptiondata)-1]
-            upsert_errors.append([str(date.today()), hub['hub_name'], contact['First Name'],contact['Last Name'],
-                                  contact['Email'], response[:999], exception[:999]])
-#  traceback.format_exc(chain = False)]
+            status_code = upsert_status_code(e)
+            retryable = status_code is not None and (status_code == 429 or status_code >= 500)
+            if not retryable or attempt == UPSERT_MAX_RETRIES:
+                raise
+            logger.info(f'''Upsert got {status_code}, retrying in {backoff} seconds''')
+            time.sleep(backoff)
+            backoff *= 2
+
+
+def subscribe_to_ea(van, new_hq_contacts, hub: dict, upsert_errors: list, api_key: str):
+    """
+    Upsert (i.e. findOrCreate) new HQ contacts into hub's EveryAction committee. Contacts whose payload matches the last
+    one upserted to the committee are skipped. The rest are sent by a pool of workers that share a rate limiter for the
+    hub's API key
+    :param van: parsons VAN object for the hub's committee
+    :param new_hq_contacts: parsons table of HQ contacts to upsert
+    :param hub: dictionary for that hub from set up sheet, retrieved by parsons
+    :param upsert_errors: list of lists that upsert errors are appended to, one row per contact
+    :param api_key: the hub's EveryAction API key, used to look up the rate limiter and the committee's upsert cache
+    :return: None
+    """
+    rate_limiter = get_rate_limiter(api_key, UPSERT_RATE, UPSERT_BURST)
+    committee = committee_key(api_key)
+    contacts = list(new_hq_contacts)
+    cached_hashes = clients.upsert_cache.load(committee, [normalize_email(contact['Email']) for contact in contacts])
+    upserted = []
+    skipped = 0
+    with ThreadPoolExecutor(max_workers=UPSERT_WORKERS) as pool:
+        futures = {}
+        for contact in contacts:
+            json = {
+          'firstName': contact['First Name'],
+          "lastName": contact['Last Name'],
+          "emails":
+                [{"email": contact['Email'],
+                "isSubscribed":'true'}]
+            }
+            email = normalize_email(contact['Email'])
+            digest = payload_hash(json)
+            if email and cached_hashes.get(email) == digest:
+                skipped += 1
+                continue
+            futures[pool.submit(upsert_contact, van, json, rate_limiter, hub['hub_name'])] = (contact, email, digest)
+        for future in as_completed(futures):
+            contact, email, digest = futures[future]
+            try:
+                response = future.result()
+                if email:
+                    van_id = response.get('vanId') if isinstance(response, dict) else None
+                    upserted.append((email, digest, van_id))
+            except Exception as e:
+                response = str(e)
+                exceptiondata = traceback.format_exc().splitlines()
+                exception = exceptiondata[len(exceptiondata)-1]
+                upsert_errors.append([str(date.today()), hub['hub_name'], contact['First Name'],contact['Last Name'],
+                                      contact['Email'], response[:999], exception[:999]])
+    clients.upsert_cache.save(committee, upserted)
+    metrics.add('ea_upsert', hub['hub_name'], skipped=skipped)
+    if skipped:
+        logger.info(f'''Skipped {skipped} {hub['hub_name']} contacts that are unchanged since they were last upserted''')
+
 
 def last_successful_syncs():
     """
@@ -103,64 +188,203 @@ hub
 FROM sunrise.hq_ea_sync_control_table
 GROUP BY hub
 '''
-    date_tbl = rs.query(sql)
+    with metrics.stage('redshift_query'):
+        date_tbl = clients.rs.query(sql)
+        metrics.add(api_calls=1)
     return date_tbl
 
+def checkpoint_batches(contacts, date_joined, batch_size: int = CHECKPOINT_BATCH_SIZE):
+    """
+    Split contacts into batches, oldest Date Joined first. A batch only ends where Date Joined changes, so contacts
+    that joined in the same second are never split across a checkpoint. Contacts without a Date Joined come last
+    :param contacts: parsons table of HQ contacts to upsert
+    :param date_joined: numpy datetime64 array of the contacts' Date Joined, from parse_hq_dates
+    :param batch_size: number of contacts per batch before extending it to the end of its Date Joined
+    :return: generator of (parsons table of the batch's contacts, newest Date Joined in the batch as a datetime or
+    None if none of the batch's contacts have one)
+    """
+    order = np.argsort(date_joined, kind='stable')
+    rows = list(contacts.data)
+    start = 0
+    while start < len(order):
+        end = min(start + batch_size, len(order))
+        while end < len(order) and date_joined[order[end]] == date_joined[order[end - 1]]:
+            end += 1
+        batch_dates = date_joined[order[start:end]]
+        batch_dates = batch_dates[~np.isnat(batch_dates)]
+        watermark = batch_dates.max().astype(datetime.datetime) if batch_dates.size else None
+        yield Table([list(contacts.columns)] + [list(rows[i]) for i in order[start:end]]), watermark
+        start = end
+
+
+def checkpoint_sync_sql(error_rows: int):
+    """
+    Build the SQL that records a checkpoint and the upsert errors of the contacts it covers
+    :param error_rows: number of sunrise.hq_ea_sync_errors rows to insert with the checkpoint
+    :return: SQL string of statements to run in one transaction, with parameters for the hub, the watermark and then
+    each error row's values
+    """
+    sql = '''
+create table if not exists sunrise.hq_ea_sync_control_table (
+    hub varchar(256),
+    date_of_ea_sync_success varchar(256)
+)
+distkey(hub)
+sortkey(date_of_ea_sync_success);
+
+insert into sunrise.hq_ea_sync_control_table (hub, date_of_ea_sync_success) values (%s, %s);
+'''
+    if error_rows:
+        values = ', '.join(['(%s, %s, %s, %s, %s, %s, %s)'] * error_rows)
+        sql += f'''
+create table if not exists {UPSERT_ERRORS_TABLE} (
+    "date" varchar(256),
+    hub varchar(256),
+    first varchar(1024),
+    last varchar(1024),
+    email varchar(1024),
+    error varchar(4096),
+    traceback varchar(4096)
+)
+distkey(error)
+sortkey("date");
+
+insert into {UPSERT_ERRORS_TABLE} ("date", hub, first, last, email, error, traceback) values {values};
+'''
+    return sql
+
+
+def checkpoint_sync(hub_name: str, watermark, upsert_errors: list):
+    """
+    Record that a hub's contacts have been synced up to and including watermark. The next run only upserts contacts
+    that joined after the newest watermark in the control table, so the upsert errors of the contacts the checkpoint
+    covers are saved in the same transaction. Otherwise a run that stopped before copying its errors would move the
+    watermark past contacts whose errors were never recorded
+    :param hub_name: name of the hub
+    :param watermark: datetime of the newest Date Joined that was synced
+    :param upsert_errors: sunrise.hq_ea_sync_errors rows for the contacts synced since the last checkpoint
+    :return: None
+    """
+    parameters = [hub_name, datetime.datetime.strftime(watermark, '%m/%d/%Y %H:%M:%S')]
+    parameters += [value for row in upsert_errors for value in row]
+    with metrics.stage('redshift_query'):
+        if upsert_errors and clients.rs.table_exists(UPSERT_ERRORS_TABLE):
+            # The errors table was first created by rs.copy, which sizes each varchar column to the rows it loaded.
+            # Widen any column these rows don't fit in, like copy's alter_table=True, since a value that's too long
+            # would roll back the checkpoint with it
+            clients.rs.alter_varchar_column_widths(Table([UPSERT_ERROR_COLUMNS] + upsert_errors), UPSERT_ERRORS_TABLE)
+            metrics.add(api_calls=2)
+        clients.rs.query(checkpoint_sync_sql(len(upsert_errors)), parameters)
+        metrics.add(api_calls=1)
+    if upsert_errors:
+        logger.info(f'''{len(upsert_errors)} errored contacts saved with {hub_name}'s checkpoint''')
+
+
+def process_hub(hub: dict, last_successful_sync_tbl):
+    """
+    Run the EveryAction sync for one hub: get the HQ contacts added since the hub's last successful sync and upsert them
+    into the hub's committee
+    :param hub: dictionary for that hub from set up sheet, retrieved by parsons
+    :param last_successful_sync_tbl: output of last_successful_syncs
+    :return: dictionary of the hub's rows for each Redshift table, keyed 'hq_errors' and 'upsert_errors'
+    """
+    hq_errors = []
+    upsert_errors = []
+    # If the HQ's Date Joined column is the same as at the hub's last sync there's nothing new to upsert
+    hidden_hq = HiddenHQ(clients.gspread_client, hub['spreadsheet_id'])
+    with metrics.stage('sheet_read'):
+        signature = date_joined_signature(hidden_hq)
+    sync_state = clients.sync_state.load('everyaction_sync', hub['spreadsheet_id'])
+    if sync_state is not None and sync_state['activity'] == signature:
+        logger.info(f'''No new contacts in {hub['hub_name']} HQ since its last sync''')
+        metrics.add('other', skipped=1)
+        return {'hq_errors': hq_errors, 'upsert_errors': upsert_errors}
+    modified_time = hidden_hq.modified_time()
+    # connect to hubs EveryAction committee
+    api_key = clients.api_keys[hub['hub_name']]
+    van = clients.van(api_key)
+    # Get hub's HQ
+    hq = get_hq(hub['spreadsheet_id'], modified_time)
+    with metrics.stage('compute', rows=hq.num_rows):
+        date_joined_values = hq['Date Joined']
+        date_joined = parse_hq_dates(date_joined_values)
+    # Contacts whose Date Joined isn't a date can't be placed before or after the last sync, so they're reported
+    # instead of failing the whole hub
+    for row_number in np.flatnonzero(np.isnat(date_joined)):
+        value = date_joined_values[row_number]
+        if value.strip():
+            hq_errors.append([str(date.today()), 'everyaction_sync', hub['hub_name'],
+                              f'''Unrecognized Date Joined: {value}'''[:999], '',
+                              f'''Hidden HQ row {row_number + 4}'''])
+    # Get last time sync succeeded for this hub
+    try:
+        date_str = last_successful_sync_tbl.select_rows(lambda row: row.hub == hub['hub_name'])
+        # Convert string to date time format
+        date_last_sync = datetime.datetime.strptime(date_str[0]['date'] + ' +00:00', "%Y-%m-%d %H:%M:%S %z")
+        # Subset HQ rows to only include contacts that joined after the last contact synced. Dates are compared for
+        # the whole column at once
+        with metrics.stage('compute', rows=hq.num_rows):
+            new_contacts_mask = date_joined > np.datetime64(date_last_sync.replace(tzinfo=None))
+            new_hq_contacts = select_rows_by_mask(hq, new_contacts_mask)
+            date_joined = date_joined[new_contacts_mask]
+    # For hubs who haven't had a sync yet
+    except (KeyError, IndexError) as e:
+        error = str(e)
+        exceptiondata = traceback.format_exc().splitlines()
+        exception = exceptiondata[len(exceptiondata)-1]
+        hq_errors.append([str(date.today()), 'everayction_sync', hub['hub_name'], error[:999], exception[:999],
+                          'if first time run for hub, hub_name will not be in control table'])
+        logger.info(f'''Upserting ALL hq records for {hub['hub_name']} hub''')
+        # Upsert all contacts in sheet
+        new_hq_contacts = hq
+
+    # Upsert new contacts to EA oldest first, saving the hub's progress and the batch's errors after each batch so a
+    # rerun picks up from the last batch that finished. Errors of batches without a watermark are copied by main
+    errored_contacts = 0
+    for batch, watermark in checkpoint_batches(new_hq_contacts, date_joined, CHECKPOINT_BATCH_SIZE):
+        batch_errors = []
+        with metrics.stage('ea_upsert', rows=batch.num_rows):
+            subscribe_to_ea(van, batch, hub, batch_errors, api_key)
+        if watermark is not None:
+            checkpoint_sync(hub['hub_name'], watermark, batch_errors)
+        else:
+            upsert_errors.extend(batch_errors)
+        errored_contacts += len(batch_errors)
+    # Only remember the sync if it went through without errors, so a hub with errors isn't skipped next run
+    if not hq_errors and not errored_contacts:
+        clients.sync_state.save('everyaction_sync', hub['spreadsheet_id'], modified_time, signature)
+    return {'hq_errors': hq_errors, 'upsert_errors': upsert_errors}
+
+
 def main():
-    hubs = parsons_sheets.get_worksheet('1ESXwSfjkDrgCRYrAag_SHiKCMIgcd1U3kz47KLNpGeA', 'cron job')
+    start_metrics('everyaction_sync')
+    hubs = get_hubs()
     last_successful_sync_tbl = last_successful_syncs()
 
-    # Open errors tables
-    upsert_errors = [['date', 'hub', 'first', 'last', 'email', 'error', 'traceback']]
-    hq_errors =[['date', 'script', 'hub', 'error', 'traceback', 'other_messages']]
-    control_table_update = [['hub', 'date_of_ea_sync_success']]
-
-    for hub in hubs:
-        # connect to hubs EveryAction committee
-        van = VAN(api_key = api_keys[hub['hub_name']], db='EveryAction')
-        # Get hub's HQ
-        hq = get_hq(hub['spreadsheet_id'])
-        # Get last time sync succeeded for this hub
-        try:
-            date_str = last_successful_sync_tbl.select_rows(lambda row: row.hub == hub['hub_name'])
-            # Convert string to date time format
-            date_last_sync = datetime.datetime.strptime(date_str[0]['date'] + ' +00:00', "%Y-%m-%d %H:%M:%S %z")
-            # Subset HQ rows to only include contacts that synced since last successful run
-            new_hq_contacts = hq.select_rows(lambda row: datetime.datetime.strptime(row['Date Joined'][:19] + ' +00:00',
-                                                "%Y-%m-%d %H:%M:%S %z") > date_last_sync)
-        # For hubs who haven't had a sync yet
-        except KeyError as e:
-            error = str(e)
-            exceptiondata = traceback.format_exc().splitlines()
-            exception = exceptiondata[len(exceptiondata)-1]
-            hq_errors.append([str(date.today()), 'everayction_sync', hub['hub_name'], error[:999], exception[:999],
-                              'if first time run for hub, hub_name will not be in control table'])
-            logger.info(f'''Upserting ALL hq records for {hub['hub_name']} hub''')
-            # Upsert all contacts in sheet
-            new_hq_contacts = hq
-
-        # Upsert new contacts to EA
-        subscribe_to_ea()
-        # get now
-        now = datetime.datetime.now(timezone.utc)
-        now_str = datetime.datetime.strftime(now,'%m/%d/%Y %H:%M:%S')
-        # add sync date to control table
-        control_table_update.append([hub['hub_name'],now_str])
-
-    rs.copy(Table(control_table_update), 'sunrise.hq_ea_sync_control_table', if_exists='append', distkey='hub',
-            sortkey='date_of_ea_sync_success', alter_table=True)
+    # Process hubs concurrently. Hubs with different API keys upsert in parallel, each at its own key's rate limit.
+    # Each hub's rows are collected separately and merged here for one copy per table to Redshift
+    results = run_hubs(hubs, partial(process_hub, last_successful_sync_tbl=last_successful_sync_tbl),
+                       'everyaction_sync')
+
+    # Open errors tables. Upsert errors of checkpointed batches were already saved with their checkpoints
+    upsert_errors = [UPSERT_ERROR_COLUMNS] + results['upsert_errors']
+    hq_errors = [['date', 'script', 'hub', 'error', 'traceback', 'other_messages']] + results['hq_errors']
     try:
-        rs.copy(Table(hq_errors), 'sunrise.hub_hq_errors', if_exists='append', distkey='hub',
+        clients.rs.copy(Table(hq_errors), 'sunrise.hub_hq_errors', if_exists='append', distkey='hub',
             sortkey='date', alter_table=True)
         logger.info(f'''{len(hq_errors)-1} errored hubs''')
     except ValueError:
         logger.info('Script executed without issue for all hubs')
     try:
-        rs.copy(Table(upsert_errors), 'sunrise.hq_ea_sync_errors', if_exists='append', distkey='error',
+        clients.rs.copy(Table(upsert_errors), UPSERT_ERRORS_TABLE, if_exists='append', distkey='error',
             sortkey='date', alter_table=True)
-        logger.info(f'''{len(hq_errors)-1} errored contacts''')
+        logger.info(f'''{len(upsert_errors)-1} errored contacts without a checkpoint''')
     except ValueError:
-        logger.info(f'''All contacts were subscribed to the correct committee without errors''')
+        logger.info(f'''No errored contacts outside of checkpointed batches''')
+    try:
+        metrics.copy_to_redshift('everyaction_sync')
+    except Exception as e:
+        logger.info(f'''Error copying metrics to Redshift: {e}''')
 
 if __name__ == '__main__':
     main()
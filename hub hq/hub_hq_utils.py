@@ -0,0 +1,1022 @@
+# Shared helpers for the Hub HQ sync scripts (mobilize_script_portfolio.py and everyaction_sync_portfolio.py).
+# Both container scripts run from this folder, so they can import this module directly.
+# Hidden HQ snapshots are optional: with HQ_SNAPSHOT_PATH set to persistent storage, sheets that haven't changed since
+# the last run aren't downloaded again. Any other change to a sheet means reading all of it, since a Drive modified
+# time can't tell appended rows from edits, so there's no read of only the rows added since the last run.
+
+import atexit
+import functools
+import hashlib
+import json
+import numbers
+import os
+import re
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import date, datetime, timezone
+
+import numpy as np
+
+# Number of hubs processed at the same time
+HUB_WORKERS = 8
+# Google Sheets allows 60 read requests and 60 write requests per minute per user, counted separately, and both
+# scripts use one service account
+SHEETS_READ_RATE = 1  # requests per second
+SHEETS_READ_BURST = 1
+SHEETS_WRITE_RATE = 1
+SHEETS_WRITE_BURST = 1
+# Drive metadata requests (modified times) have their own quota of 1,000 requests per 100 seconds per user
+DRIVE_RATE = 10
+DRIVE_BURST = 10
+
+# Hidden HQ goes out to column L
+HQ_MIN_WIDTH = 12
+# Rows read and written at a time when a Hidden HQ is processed in windows instead of all at once
+HQ_WINDOW_ROWS = 5000
+# Rows fetched at a time from Redshift when a query's results are streamed instead of loaded all at once
+STREAM_BATCH_SIZE = 10000
+DRIVE_FILES_URL = 'https://www.googleapis.com/drive/v3/files'
+
+# Cache of the last payload upserted to EveryAction for each contact, so unchanged contacts aren't re-sent
+UPSERT_CACHE_TABLE = 'sunrise.hub_hq_ea_upserts'
+# Contacts saved to the upsert cache per insert statement
+UPSERT_CACHE_INSERT_ROWS = 1000
+# Each script's sync state for each hub, used to skip hubs that haven't changed since they were last synced
+HUB_SYNC_STATE_TABLE = 'sunrise.hub_hq_sync_state'
+
+# Per hub, per stage timings are copied here at the end of each run
+METRICS_TABLE = 'sunrise.hub_hq_metrics'
+# If set, a JSON summary of the run's metrics is written to this path when the script exits
+METRICS_JSON_PATH = os.environ.get('HUB_HQ_METRICS_JSON')
+
+# Spreadsheet with the cron job sheet that lists every hub and its HQ
+CRON_JOB_SPREADSHEET_ID = '1ESXwSfjkDrgCRYrAag_SHiKCMIgcd1U3kz47KLNpGeA'
+GOOGLE_SCOPE = [
+    'https://spreadsheets.google.com/feeds',
+    'https://www.googleapis.com/auth/drive',
+]
+
+
+class RateLimiter:
+    """
+    Thread safe token bucket. Each call to acquire takes one token, waiting until one is available. Tokens refill at
+    `rate` per second up to `burst` tokens.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        """
+        :param rate: tokens added per second (i.e. the sustained request rate)
+        :param burst: max number of tokens that can be saved up and spent at once
+        """
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a token is available and take it
+        :return: seconds spent waiting
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(key: str, rate: float, burst: int = 1):
+    """
+    Get the shared rate limiter for a key (e.g. an API key), creating it the first time it's requested
+    :param key: anything that identifies the quota being limited
+    :param rate: tokens per second, only used when the limiter is created
+    :param burst: bucket size, only used when the limiter is created
+    :return: RateLimiter
+    """
+    with _limiters_lock:
+        if key not in _limiters:
+            _limiters[key] = RateLimiter(rate, burst)
+        return _limiters[key]
+
+
+class ClientRegistry:
+    """
+    Lazily created clients shared by every hub. Nothing is authorized or read from the environment until a client is
+    first used, so importing the sync scripts has no side effects. Each client is created once and cached; set() swaps
+    in stand-ins (e.g. for benchmarks) before anything is created
+    """
+
+    def __init__(self):
+        self._clients = {}
+        self._lock = threading.RLock()
+
+    def _get(self, name: str, factory):
+        with self._lock:
+            if name not in self._clients:
+                self._clients[name] = factory()
+            return self._clients[name]
+
+    def set(self, **clients):
+        """
+        Use the given objects instead of creating clients, e.g. set(rs=fake_redshift)
+        :param clients: client objects keyed by property name
+        :return: None
+        """
+        with self._lock:
+            self._clients.update(clients)
+
+    def set_van(self, api_key: str, van):
+        """
+        Use the given object as the VAN client for an API key instead of creating one
+        :param api_key: the committee's API key
+        :param van: object to use in place of parsons VAN
+        :return: None
+        """
+        with self._lock:
+            self._clients[('van', api_key)] = van
+
+    @property
+    def rs(self):
+        """parsons Redshift connection"""
+        def create():
+            from parsons import Redshift
+            # Set environ using civis credentials from container script
+            os.environ['REDSHIFT_DB'] = os.environ['REDSHIFT_DATABASE']
+            os.environ['REDSHIFT_USERNAME'] = os.environ['REDSHIFT_CREDENTIAL_USERNAME']
+            os.environ['REDSHIFT_PASSWORD'] = os.environ['REDSHIFT_CREDENTIAL_PASSWORD']
+            os.environ['S3_TEMP_BUCKET'] = 'parsons-tmc'
+            return Redshift()
+        return self._get('rs', create)
+
+    @property
+    def creds(self):
+        """Google service account credentials as a dictionary"""
+        return self._get('creds', lambda: json.loads(os.environ['GOOGLE_JSON_CRED_PASSWORD']))
+
+    @property
+    def gspread_client(self):
+        """Authorized gspread client. Its session is shared by every hub"""
+        def create():
+            import gspread
+            from oauth2client.service_account import ServiceAccountCredentials
+            credentials = ServiceAccountCredentials.from_json_keyfile_dict(self.creds, GOOGLE_SCOPE)
+            return gspread.authorize(credentials)
+        return self._get('gspread_client', create)
+
+    @property
+    def api_keys(self):
+        """EveryAction API keys keyed by hub name"""
+        return self._get('api_keys', lambda: json.loads(os.environ['EVERYACTION_KEYS_PASSWORD']))
+
+    @property
+    def snapshot_store(self):
+        """
+        HQSnapshotStore for Hidden HQ snapshots, so runs don't download sheets that haven't changed since the last run,
+        or None if HQ_SNAPSHOT_PATH isn't set. Set it to a file on storage that's kept between runs, e.g. a mounted
+        volume. A container's working directory is thrown away when the run ends, so without it every sheet is read
+        """
+        def create():
+            path = os.environ.get('HQ_SNAPSHOT_PATH')
+            return HQSnapshotStore(path) if path else None
+        return self._get('snapshot_store', create)
+
+    @property
+    def upsert_cache(self):
+        """UpsertCache of contacts already upserted to EveryAction, kept in Redshift"""
+        return self._get('upsert_cache', lambda: UpsertCache(self.rs))
+
+    @property
+    def sync_state(self):
+        """HubSyncState of what each script last synced for each hub, kept in Redshift"""
+        return self._get('sync_state', lambda: HubSyncState(self.rs))
+
+    def van(self, api_key: str):
+        """
+        Get the parsons VAN client for an EveryAction committee
+        :param api_key: the committee's API key
+        :return: parsons VAN object, shared by every hub that uses the key
+        """
+        def create():
+            from parsons import VAN
+            return VAN(api_key=api_key, db='EveryAction')
+        return self._get(('van', api_key), create)
+
+
+# Clients used by both sync scripts
+clients = ClientRegistry()
+
+
+def get_hubs():
+    """
+    Get the cron job sheet, which has one row per hub with its hub_name, hub_email and HQ spreadsheet_id
+    :return: Parson's table of hubs
+    """
+    from parsons import Table
+    sheets_call()
+    spreadsheet = clients.gspread_client.open_by_key(CRON_JOB_SPREADSHEET_ID)
+    sheets_call()
+    worksheet = spreadsheet.worksheet('cron job')
+    sheets_call()
+    return Table(worksheet.get_all_values())
+
+
+class Metrics:
+    """
+    Collects how long each stage of each hub's run takes (sheet read, Redshift query, compute, sheet write, EA upsert),
+    along with row, API call, retry and skipped (e.g. cached) counts. The hub being processed is tracked per thread by
+    run_hubs, and stages can be nested; a stage's time doesn't include the time spent in stages inside it
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.records = {}
+
+    def reset(self):
+        with self._lock:
+            self.records = {}
+
+    @property
+    def hub(self):
+        """Name of the hub the current thread is processing"""
+        return getattr(self._local, 'hub', None) or 'all hubs'
+
+    @contextmanager
+    def for_hub(self, hub_name: str):
+        """
+        Attribute metrics recorded by this thread to a hub
+        :param hub_name: name of the hub
+        """
+        previous = getattr(self._local, 'hub', None)
+        self._local.hub = hub_name
+        try:
+            yield
+        finally:
+            self._local.hub = previous
+
+    def _record(self, hub_name: str, stage: str):
+        # Caller holds the lock
+        key = (hub_name, stage)
+        if key not in self.records:
+            self.records[key] = {'seconds': 0.0, 'rows': 0, 'api_calls': 0, 'retries': 0, 'skipped': 0}
+        return self.records[key]
+
+    def add(self, stage: str = None, hub_name: str = None, **counts):
+        """
+        Add to the counts for a stage, e.g. add(rows=10) or add('ea_upsert', hub_name, retries=1)
+        :param stage: stage name. Defaults to the stage the current thread is in
+        :param hub_name: hub name. Defaults to the hub the current thread is processing
+        :param counts: amounts to add to seconds, rows, api_calls, retries and/or skipped
+        :return: None
+        """
+        stack = getattr(self._local, 'stages', None)
+        stage = stage or (stack[-1][0] if stack else 'other')
+        hub_name = hub_name or self.hub
+        with self._lock:
+            record = self._record(hub_name, stage)
+            for name, amount in counts.items():
+                record[name] += amount
+
+    @contextmanager
+    def stage(self, stage: str, rows: int = None):
+        """
+        Time a stage for the current hub
+        :param stage: stage name
+        :param rows: rows handled by the stage, if known up front
+        """
+        if not hasattr(self._local, 'stages'):
+            self._local.stages = []
+        stack = self._local.stages
+        # Each entry is [stage name, seconds spent in stages nested inside it]
+        stack.append([stage, 0.0])
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            _, nested = stack.pop()
+            if stack:
+                stack[-1][1] += elapsed
+            self.add(stage, seconds=elapsed - nested, rows=rows or 0)
+
+    def rows(self, script: str):
+        """
+        Get the metrics as rows for METRICS_TABLE
+        :param script: name of the script
+        :return: list of lists, starting with the column names
+        """
+        today = str(date.today())
+        with self._lock:
+            return [['date', 'script', 'hub', 'stage', 'seconds', 'rows', 'api_calls', 'retries', 'skipped']] + [
+                [today, script, hub_name, stage, round(record['seconds'], 3), record['rows'], record['api_calls'],
+                 record['retries'], record['skipped']]
+                for (hub_name, stage), record in sorted(self.records.items())]
+
+    def summary(self, script: str):
+        """
+        Summarize the metrics by stage and by hub
+        :param script: name of the script
+        :return: dictionary that can be dumped to JSON
+        """
+        stages = defaultdict(lambda: {'seconds': 0.0, 'rows': 0, 'api_calls': 0, 'retries': 0, 'skipped': 0})
+        hubs = defaultdict(float)
+        with self._lock:
+            for (hub_name, stage), record in self.records.items():
+                for name, amount in record.items():
+                    stages[stage][name] += amount
+                hubs[hub_name] += record['seconds']
+        slowest_hubs = sorted(hubs.items(), key=lambda item: item[1], reverse=True)[:10]
+        return {'script': script, 'date': str(date.today()), 'stages': dict(stages),
+                'slowest_hubs': [{'hub': hub_name, 'seconds': seconds} for hub_name, seconds in slowest_hubs]}
+
+    def write_json(self, script: str, path: str):
+        """
+        Write the summary to a JSON file
+        :param script: name of the script
+        :param path: file path
+        :return: None
+        """
+        with open(path, 'w') as f:
+            json.dump(self.summary(script), f, indent=2)
+
+    def copy_to_redshift(self, script: str):
+        """
+        Append the metrics to METRICS_TABLE
+        :param script: name of the script
+        :return: None
+        """
+        from parsons import Table
+        rows = self.rows(script)
+        if len(rows) > 1:
+            clients.rs.copy(Table(rows), METRICS_TABLE, if_exists='append', distkey='hub', sortkey='date',
+                            alter_table=True)
+
+
+# Metrics for the current run
+metrics = Metrics()
+
+
+def timed(stage: str):
+    """
+    Decorator that times every call of a function as a stage for the current hub
+    :param stage: stage name
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with metrics.stage(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def start_metrics(script: str):
+    """
+    Clear the metrics for a new run, and write the JSON summary when the script exits if HUB_HQ_METRICS_JSON is set
+    :param script: name of the script
+    :return: None
+    """
+    metrics.reset()
+    if METRICS_JSON_PATH:
+        atexit.register(metrics.write_json, script, METRICS_JSON_PATH)
+
+
+def sheets_call(kind: str = 'read'):
+    """
+    Wait for the shared Google quota the request counts against and count the call for the current hub and stage. Call
+    right before each Sheets or Drive request
+    :param kind: 'read' or 'write' for Sheets requests, 'drive' for Drive requests
+    :return: None
+    """
+    sheets_rate_limiter(kind).acquire()
+    metrics.add(api_calls=1)
+
+
+def sheets_rate_limiter(kind: str = 'read'):
+    """
+    Get the rate limiter shared by every Google request of one kind the script makes. Sheets reads, Sheets writes and
+    Drive requests have separate quotas, so each kind has its own limiter
+    :param kind: 'read' or 'write' for Sheets requests, 'drive' for Drive requests
+    :return: RateLimiter
+    """
+    rate, burst = {
+        'read': (SHEETS_READ_RATE, SHEETS_READ_BURST),
+        'write': (SHEETS_WRITE_RATE, SHEETS_WRITE_BURST),
+        'drive': (DRIVE_RATE, DRIVE_BURST),
+    }[kind]
+    return get_rate_limiter(f'''google_{kind}''', rate, burst)
+
+
+def error_row(script: str, hub_name: str, message: str, e: Exception):
+    """
+    Build a row for sunrise.hub_hq_errors from an exception
+    :param script: name of the script the error came from
+    :param hub_name: name of the hub that errored
+    :param message: description of what was being done when the error happened
+    :param e: the exception
+    :return: list with the values for each hub_hq_errors column
+    """
+    response = str(e)
+    exceptiondata = traceback.format_exception(type(e), e, e.__traceback__)
+    exception = ''.join(exceptiondata).splitlines()[-1]
+    return [str(date.today()), script, hub_name, message, response[:999], exception[:999]]
+
+
+def _process_hub_with_metrics(process_hub, hub: dict):
+    # Attribute everything this thread records to the hub, and time whatever isn't in a stage as 'other'
+    with metrics.for_hub(hub['hub_name']), metrics.stage('other'):
+        return process_hub(hub)
+
+
+def run_hubs(hubs, process_hub, script: str, max_workers: int = HUB_WORKERS):
+    """
+    Run process_hub for every hub on a bounded thread pool. process_hub returns a dictionary of lists of rows keyed by
+    the table they belong in (e.g. {'hq_errors': [...], 'control_table': [...]}), and the rows from every hub are merged
+    by key so each table can be pushed to Redshift with one copy at the end. If process_hub raises, the hub's error is
+    added to 'hq_errors' and the other hubs carry on
+    :param hubs: iterable of hub dictionaries from set up sheet, retrieved by parsons
+    :param process_hub: function that takes a hub dictionary and returns a dictionary of lists of rows
+    :param script: name of the script, used for error rows
+    :param max_workers: number of hubs to process at the same time
+    :return: dictionary of lists of rows merged across hubs
+    """
+    merged = defaultdict(list)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(_process_hub_with_metrics, process_hub, hub): hub for hub in hubs}
+        for future in as_completed(futures):
+            hub = futures[future]
+            try:
+                rows = future.result()
+            except Exception as e:
+                merged['hq_errors'].append(error_row(script, hub['hub_name'], 'Error processing hub', e))
+                continue
+            for table, table_rows in (rows or {}).items():
+                merged[table].extend(table_rows)
+    return merged
+
+
+def parse_hq_dates(values):
+    """
+    Parse a column of date strings (e.g. Date Joined, formatted like 2021-03-04 12:34:56.789) in one go. Only the first
+    19 characters are used, matching how the scripts parse single dates with "%Y-%m-%d %H:%M:%S"
+    :param values: list of date strings, in UTC
+    :return: numpy datetime64[s] array. Empty strings and values that aren't dates become NaT, which is never greater
+    or less than a date
+    """
+    values = [value[:19].replace(' ', 'T', 1) for value in values]
+    try:
+        return np.array(values, dtype='datetime64[s]')
+    except ValueError:
+        # Parse one value at a time so a malformed date only affects its own row
+        dates = np.full(len(values), np.datetime64('NaT'), dtype='datetime64[s]')
+        for i, value in enumerate(values):
+            try:
+                dates[i] = np.datetime64(value, 's')
+            except ValueError:
+                pass
+        return dates
+
+
+def utc_today():
+    """
+    Today's date in UTC, the same day Redshift's getdate() uses for the days since fields
+    :return: date string, e.g. '2024-01-31'
+    """
+    return str(datetime.now(timezone.utc).date())
+
+
+def column_letter(column_number: int):
+    """
+    Convert a 1-based column number to its spreadsheet column letter(s), e.g. 6 -> F
+    :param column_number: 1-based column number
+    :return: column letter(s) as a string
+    """
+    letters = ''
+    while column_number > 0:
+        column_number, remainder = divmod(column_number - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+def a1_start(range_name: str):
+    """
+    Get the top left cell of an A1 notation range, e.g. 'F4:L' -> (3, 5)
+    :param range_name: A1 notation range without the worksheet name
+    :return: tuple of 0-based (row index, column index)
+    """
+    letters, digits = re.match(r'([A-Z]*)(\d*)', range_name.split(':')[0]).groups()
+    column = 0
+    for letter in letters:
+        column = column * 26 + ord(letter) - 64
+    return int(digits or 1) - 1, max(column, 1) - 1
+
+
+def key_checksum(keys: list):
+    """
+    Checksum of a column of values, used to tell whether a column changed since it was last synced
+    :param keys: list of cell values
+    :return: hex digest
+    """
+    return hashlib.sha1('\n'.join(keys).encode('utf-8')).hexdigest()
+
+
+def normalize_email(email):
+    """
+    Normalize an email for matching, so case and stray whitespace don't cause missed matches
+    :param email: email string (or None)
+    :return: stripped, lowercase email
+    """
+    return (email or '').strip().lower()
+
+
+def committee_key(api_key: str):
+    """
+    Identify an EveryAction committee by a hash of its API key, so the key itself is never written to disk
+    :param api_key: the committee's API key
+    :return: hex digest
+    """
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:16]
+
+
+def payload_hash(payload: dict):
+    """
+    Hash of an upsert payload that doesn't depend on key order
+    :param payload: json for van.upsert_person_json
+    :return: hex digest
+    """
+    return hashlib.sha1(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class HQSnapshotStore:
+    """
+    SQLite store of the last Hidden HQ values read or written for each spreadsheet, along with the Drive modified time
+    of the sheet the values match
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: path to the SQLite file, on storage that's kept between runs. It's created if it doesn't exist
+        """
+        self.path = path
+        with self._connect() as connection:
+            connection.execute('''
+create table if not exists hq_snapshots (
+    spreadsheet_id text primary key,
+    modified_time text,
+    rows text
+)''')
+
+    def _connect(self):
+        # A connection per call keeps the store safe to use from the hub worker threads
+        return sqlite3.connect(self.path, timeout=60)
+
+    def load(self, spreadsheet_id: str):
+        """
+        Get the snapshot for a spreadsheet
+        :param spreadsheet_id: spreadsheet ID for the hub's HQ
+        :return: dictionary with modified_time and rows, or None
+        """
+        with self._connect() as connection:
+            snapshot = connection.execute(
+                'select modified_time, rows from hq_snapshots where spreadsheet_id = ?', (spreadsheet_id,)).fetchone()
+        if snapshot is None:
+            return None
+        return {'modified_time': snapshot[0], 'rows': json.loads(snapshot[1])}
+
+    def save(self, spreadsheet_id: str, rows: list, modified_time: str = None):
+        """
+        Save the snapshot for a spreadsheet
+        :param spreadsheet_id: spreadsheet ID for the hub's HQ
+        :param rows: list of lists of every row in the worksheet, starting from row 1
+        :param modified_time: Drive modified time of the sheet when the rows were read. Pass None after writing to the
+        sheet, so the next read downloads the sheet again unless the snapshot is marked with set_modified_time
+        :return: None
+        """
+        with self._connect() as connection:
+            connection.execute('insert or replace into hq_snapshots values (?, ?, ?)',
+                               (spreadsheet_id, modified_time, json.dumps(rows)))
+
+    def set_modified_time(self, spreadsheet_id: str, modified_time: str):
+        """
+        Mark a snapshot as matching the sheet at the given Drive modified time, e.g. after writing the snapshot's values
+        to the sheet
+        :param spreadsheet_id: spreadsheet ID for the hub's HQ
+        :param modified_time: Drive modified time of the sheet
+        :return: None
+        """
+        with self._connect() as connection:
+            connection.execute('update hq_snapshots set modified_time = ? where spreadsheet_id = ?',
+                               (modified_time, spreadsheet_id))
+
+    def delete(self, spreadsheet_id: str):
+        """
+        Drop the snapshot for a spreadsheet, e.g. after the sheet was written without keeping the snapshot in line
+        :param spreadsheet_id: spreadsheet ID for the hub's HQ
+        :return: None
+        """
+        with self._connect() as connection:
+            connection.execute('delete from hq_snapshots where spreadsheet_id = ?', (spreadsheet_id,))
+
+
+class UpsertCache:
+    """
+    Redshift cache of the last payload upserted to EveryAction for each contact, keyed by committee and normalized
+    email, along with the VAN ID EveryAction returned. A contact whose payload hash matches the cache doesn't need to
+    be sent again. Rows are only ever appended, so hubs saving at the same time never conflict, and the newest row for
+    a contact is the one that counts. Each committee's hashes are read once per run and kept in memory
+    """
+
+    def __init__(self, rs, table: str = UPSERT_CACHE_TABLE):
+        """
+        :param rs: parsons Redshift connection
+        :param table: schema qualified name of the cache table. It's created if it doesn't exist
+        """
+        self.rs = rs
+        self.table = table
+        self._hashes = {}
+        self._lock = threading.Lock()
+        rs.query(f'''
+create table if not exists {table} (
+    committee varchar(16),
+    email varchar(256),
+    payload_hash varchar(40),
+    van_id bigint,
+    upserted_at timestamp
+)
+distkey(email)
+sortkey(committee, email)''')
+
+    def _committee_hashes(self, committee: str):
+        # Read the committee's newest hash for each contact the first time any of its hubs needs them
+        with self._lock:
+            if committee not in self._hashes:
+                with metrics.stage('redshift_query'):
+                    cached = self.rs.query(f'''
+select email, payload_hash
+from
+(
+    select
+        email,
+        payload_hash,
+        row_number() over (partition by email order by upserted_at desc) = 1 as is_most_recent
+    from {self.table}
+    where committee = %s
+) upserts
+where is_most_recent = true''', [committee])
+                    metrics.add(api_calls=1, rows=0 if cached is None else cached.num_rows)
+                self._hashes[committee] = {} if cached is None else {row['email']: row['payload_hash']
+                                                                     for row in cached}
+            return self._hashes[committee]
+
+    def load(self, committee: str, emails: list):
+        """
+        Get the cached payload hashes for a committee's contacts
+        :param committee: committee_key of the committee's API key
+        :param emails: list of normalized emails
+        :return: dictionary of payload hash by normalized email, for the emails that are cached
+        """
+        hashes = self._committee_hashes(committee)
+        with self._lock:
+            return {email: hashes[email] for email in set(emails) if email in hashes}
+
+    def save(self, committee: str, upserts: list):
+        """
+        Record contacts that were upserted
+        :param committee: committee_key of the committee's API key
+        :param upserts: list of (normalized email, payload hash, VAN ID) tuples
+        :return: None
+        """
+        if not upserts:
+            return
+        for start in range(0, len(upserts), UPSERT_CACHE_INSERT_ROWS):
+            chunk = upserts[start:start + UPSERT_CACHE_INSERT_ROWS]
+            values = ', '.join(['(%s, %s, %s, %s, getdate())'] * len(chunk))
+            parameters = [value for email, digest, van_id in chunk for value in (committee, email, digest, van_id)]
+            with metrics.stage('redshift_query'):
+                self.rs.query(f'''insert into {self.table} values {values}''', parameters)
+                metrics.add(api_calls=1)
+        hashes = self._committee_hashes(committee)
+        with self._lock:
+            hashes.update((email, digest) for email, digest, _ in upserts)
+
+
+class HubSyncState:
+    """
+    Redshift table of what each script saw the last time it synced a hub without errors, used to skip hubs that haven't
+    changed since. Rows are only ever appended, so hubs saving at the same time never conflict, and the newest row for
+    a script and spreadsheet is the one that counts. Each script's state is read once per run and kept in memory
+    """
+
+    def __init__(self, rs, table: str = HUB_SYNC_STATE_TABLE):
+        """
+        :param rs: parsons Redshift connection
+        :param table: schema qualified name of the sync state table. It's created if it doesn't exist
+        """
+        self.rs = rs
+        self.table = table
+        self._states = {}
+        self._lock = threading.Lock()
+        rs.query(f'''
+create table if not exists {table} (
+    script varchar(64),
+    spreadsheet_id varchar(256),
+    modified_time varchar(64),
+    activity varchar(1024),
+    synced_at timestamp
+)
+distkey(spreadsheet_id)
+sortkey(script, spreadsheet_id)''')
+
+    def _script_states(self, script: str):
+        # Read the newest state of every hub the first time the script needs any of them
+        with self._lock:
+            if script not in self._states:
+                with metrics.stage('redshift_query'):
+                    states = self.rs.query(f'''
+select spreadsheet_id, modified_time, activity, synced_at::date::text as synced_on
+from
+(
+    select
+        spreadsheet_id,
+        modified_time,
+        activity,
+        synced_at,
+        row_number() over (partition by spreadsheet_id order by synced_at desc) = 1 as is_most_recent
+    from {self.table}
+    where script = %s
+) states
+where is_most_recent = true''', [script])
+                    metrics.add(api_calls=1)
+                self._states[script] = {} if states is None else {
+                    row['spreadsheet_id']: {'modified_time': row['modified_time'], 'activity': row['activity'],
+                                            'synced_on': row['synced_on']} for row in states}
+            return self._states[script]
+
+    def load(self, script: str, spreadsheet_id: str):
+        """
+        Get what a script saw the last time it synced a hub without errors
+        :param script: name of the script
+        :param spreadsheet_id: spreadsheet ID for the hub's HQ
+        :return: dictionary with modified_time, activity and synced_on, or None
+        """
+        states = self._script_states(script)
+        with self._lock:
+            state = states.get(spreadsheet_id)
+            return None if state is None else dict(state)
+
+    def save(self, script: str, spreadsheet_id: str, modified_time: str, activity: str = None):
+        """
+        Record that a script synced a hub without errors
+        :param script: name of the script
+        :param spreadsheet_id: spreadsheet ID for the hub's HQ
+        :param modified_time: Drive modified time of the sheet after the sync
+        :param activity: summary of the hub's source data that was synced, e.g. from get_hub_activity
+        :return: None
+        """
+        with metrics.stage('redshift_query'):
+            self.rs.query(f'''insert into {self.table} values (%s, %s, %s, %s, getdate())''',
+                          [script, spreadsheet_id, modified_time, activity])
+            metrics.add(api_calls=1)
+        states = self._script_states(script)
+        with self._lock:
+            states[spreadsheet_id] = {'modified_time': modified_time, 'activity': activity, 'synced_on': utc_today()}
+
+
+class HiddenHQ:
+    """
+    Handle on a hub's Hidden HQ worksheet. The spreadsheet and worksheet are only opened the first time they're needed,
+    and any worksheet attribute (update, batch_update, ...) can be used on the handle directly
+    """
+
+    def __init__(self, client, spreadsheet_id: str, worksheet_name: str = 'Hidden HQ'):
+        """
+        :param client: authorized gspread client
+        :param spreadsheet_id: spreadsheet ID for the hub's HQ
+        :param worksheet_name: name of the worksheet
+        """
+        self.client = client
+        self.spreadsheet_id = spreadsheet_id
+        self.worksheet_name = worksheet_name
+        self._spreadsheet = None
+        self._worksheet = None
+
+    @property
+    def spreadsheet(self):
+        if self._spreadsheet is None:
+            sheets_call()
+            self._spreadsheet = self.client.open_by_key(self.spreadsheet_id)
+        return self._spreadsheet
+
+    @property
+    def worksheet(self):
+        if self._worksheet is None:
+            spreadsheet = self.spreadsheet
+            sheets_call()
+            self._worksheet = spreadsheet.worksheet(self.worksheet_name)
+        return self._worksheet
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.worksheet, name)
+
+    def modified_time(self):
+        """
+        Get the time the spreadsheet was last modified from the Drive API, without opening the spreadsheet
+        :return: modified time as an RFC 3339 string
+        """
+        sheets_call('drive')
+        response = self.client.request('get', f'''{DRIVE_FILES_URL}/{self.spreadsheet_id}''',
+                                       params={'fields': 'modifiedTime', 'supportsAllDrives': 'true'})
+        return response.json()['modifiedTime']
+
+    def values(self, range_name: str):
+        """
+        Get a range of values from the worksheet
+        :param range_name: A1 notation range without the worksheet name, e.g. 'A10:L'
+        :return: list of lists of values. Trailing empty rows and cells are left out
+        """
+        spreadsheet = self.spreadsheet
+        sheets_call()
+        response = spreadsheet.values_get(f''''{self.worksheet_name}'!{range_name}''')
+        return response.get('values', [])
+
+
+class SheetWriteBatch:
+    """
+    Queue of writes to a Hidden HQ (range updates and appended rows) that are sent together as one
+    spreadsheets.batchUpdate request when flushed, instead of one round trip per write. Values are written as they are,
+    like the RAW value input option
+    """
+
+    def __init__(self, hidden_hq: HiddenHQ):
+        """
+        :param hidden_hq: HiddenHQ handle for the hub's sheet
+        """
+        self.hidden_hq = hidden_hq
+        self.requests = []
+        self.cells = 0
+        # One dictionary per batchUpdate request sent: requests, cells and seconds
+        self.timings = []
+
+    @staticmethod
+    def _row_data(values: list):
+        cells = []
+        for value in values:
+            # Cells without a value are cleared
+            if value is None:
+                cells.append({})
+            elif isinstance(value, bool):
+                cells.append({'userEnteredValue': {'boolValue': value}})
+            elif isinstance(value, numbers.Number):
+                number = int(value) if isinstance(value, numbers.Integral) else float(value)
+                cells.append({'userEnteredValue': {'numberValue': number}})
+            else:
+                cells.append({'userEnteredValue': {'stringValue': str(value)}})
+        return {'values': cells}
+
+    def update(self, range_name: str, values: list):
+        """
+        Queue a range update, the same as worksheet.update
+        :param range_name: A1 notation range without the worksheet name. Values are written from its top left cell
+        :param values: list of lists of values
+        :return: None
+        """
+        row_index, column_index = a1_start(range_name)
+        self.requests.append({'updateCells': {
+            'start': {'sheetId': self.hidden_hq.id, 'rowIndex': row_index, 'columnIndex': column_index},
+            'rows': [self._row_data(row) for row in values],
+            'fields': 'userEnteredValue'
+        }})
+        self.cells += sum(len(row) for row in values)
+
+    def batch_update(self, data: list):
+        """
+        Queue several range updates, the same as worksheet.batch_update
+        :param data: list of {'range': ..., 'values': ...} dictionaries
+        :return: None
+        """
+        for update in data:
+            self.update(update['range'], update['values'])
+
+    def append_rows(self, values: list):
+        """
+        Queue rows to append after the last row with data, the same as worksheet.append_rows
+        :param values: list of lists of values, one per row
+        :return: None
+        """
+        if not values:
+            return
+        self.requests.append({'appendCells': {
+            'sheetId': self.hidden_hq.id,
+            'rows': [self._row_data(row) for row in values],
+            'fields': 'userEnteredValue'
+        }})
+        self.cells += sum(len(row) for row in values)
+
+    def flush(self):
+        """
+        Send the queued writes as one spreadsheets.batchUpdate request. They're applied in the order they were queued
+        :return: dictionary with the number of requests and cells sent and the seconds it took, or None if nothing was
+        queued
+        """
+        if not self.requests:
+            return None
+        with metrics.stage('sheet_write', rows=self.cells):
+            sheets_call('write')
+            start = time.perf_counter()
+            self.hidden_hq.spreadsheet.batch_update({'requests': self.requests})
+            timing = {'requests': len(self.requests), 'cells': self.cells, 'seconds': time.perf_counter() - start}
+            metrics.add(api_calls=1)
+        self.timings.append(timing)
+        self.requests = []
+        self.cells = 0
+        return timing
+
+
+@timed('sheet_read')
+def read_hidden_hq(hidden_hq: HiddenHQ, store: HQSnapshotStore = None, modified_time: str = None):
+    """
+    Get every row of a Hidden HQ, the same as worksheet.get_all_values(). If the sheet hasn't been modified since the
+    snapshot was taken, the snapshot is returned without reading the sheet. Otherwise the whole worksheet is read, since
+    a modified time can't tell rows appended to the sheet from edits to the rows already in it. There's no read of just
+    the appended rows: any change made outside the Mobilize script (which keeps the snapshot in line with its own
+    writes) costs a full read
+    :param hidden_hq: HiddenHQ handle for the hub's sheet
+    :param store: HQSnapshotStore, or None to always read the whole sheet
+    :param modified_time: the sheet's Drive modified time, if the caller already has it
+    :return: list of lists of every row in the worksheet, starting from row 1
+    """
+    if store is None:
+        sheets_call()
+        return hidden_hq.get_all_values()
+    spreadsheet_id = hidden_hq.spreadsheet_id
+    modified_time = modified_time or hidden_hq.modified_time()
+    snapshot = store.load(spreadsheet_id)
+    if snapshot is not None and snapshot['modified_time'] == modified_time:
+        return snapshot['rows']
+    sheets_call()
+    rows = hidden_hq.get_all_values()
+    store.save(spreadsheet_id, rows, modified_time)
+    return rows
+
+
+def read_hidden_hq_windows(hidden_hq: HiddenHQ, first_row: int = 1, window_rows: int = HQ_WINDOW_ROWS):
+    """
+    Read a Hidden HQ in fixed size windows of rows with ranged reads, so only one window is held at a time. The
+    snapshot store isn't used
+    :param hidden_hq: HiddenHQ handle for the hub's sheet
+    :param first_row: sheet row number (starting from 1) to start reading from
+    :param window_rows: rows per window
+    :return: generator of (sheet row number of the window's first row, list of lists of the window's rows, padded to
+    the same width like get_all_values). Windows of blank rows are skipped
+    """
+    # The sheet's grid size is an upper bound on the rows with data, since blank rows are left out of ranged reads
+    last_row = hidden_hq.row_count
+    for window_start in range(first_row, last_row + 1, window_rows):
+        window_end = min(window_start + window_rows - 1, last_row)
+        with metrics.stage('sheet_read'):
+            rows = hidden_hq.values(f'''A{window_start}:{column_letter(HQ_MIN_WIDTH)}{window_end}''')
+        metrics.add('sheet_read', rows=len(rows))
+        if rows:
+            yield window_start, [row + [''] * (HQ_MIN_WIDTH - len(row)) for row in rows]
+
+
+def stream_query(sql: str, batch_size: int = STREAM_BATCH_SIZE):
+    """
+    Run a Redshift query through a server-side (named) cursor, so rows are fetched in batches as they're used instead
+    of loading the whole result into a parsons table
+    :param sql: query
+    :param batch_size: rows fetched from Redshift at a time
+    :return: generator of dictionaries, one per row
+    """
+    with clients.rs.connection() as connection:
+        cursor = connection.cursor(name=f'''hub_hq_{uuid.uuid4().hex}''')
+        cursor.itersize = batch_size
+        cursor.execute(sql)
+        metrics.add(api_calls=1)
+        columns = None
+        for row in cursor:
+            # A named cursor's description is only set once the first batch has been fetched
+            if columns is None:
+                columns = [column[0] for column in cursor.description]
+            yield dict(zip(columns, row))
+        cursor.close()
@@ -4,17 +4,24 @@
 # with their contact info and event attendance history. It compares those contacts to the contacts in HQ Spreadsheet
 # for that hub and updates event attendance history for any contacts that already exist in HQ sheet, and appends any
 # new Mobilize contacts that don't have a match in HQ sheet. Match is based on email.
+# Event attendance history is kept up to date incrementally in the sunrise.hub_hq_mobilize_* tables, so each run only
+# reads the newest participations from sunrise_mobilize.
 # Errors are logged in sunrise.hub_hq_errors
 
 # Import necessary packages
-import json
-from parsons import GoogleSheets, Redshift, Table
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+import hashlib
+import re
+from array import array
+from collections.abc import Mapping
+from parsons import Table
 import logging
-from datetime import timezone, timedelta
+from datetime import timezone, date
 import datetime
-import os
+from functools import partial
+import numpy as np
+from hub_hq_utils import (HQ_WINDOW_ROWS, HiddenHQ, SheetWriteBatch, clients, column_letter, error_row, get_hubs,
+                          metrics, normalize_email, parse_hq_dates, read_hidden_hq, read_hidden_hq_windows, run_hubs,
+                          start_metrics, stream_query, timed, utc_today)
 
 ##### Set up logger #####
 logger = logging.getLogger(__name__)
@@ -24,28 +31,6 @@ _handler.setFormatter(_formatter)
 logger.addHandler(_handler)
 logger.setLevel('INFO')
 
-# Set environ using civis credentials from container script
-os.environ['REDSHIFT_DB'] = os.environ['REDSHIFT_DATABASE']
-os.environ['REDSHIFT_USERNAME'] = os.environ['REDSHIFT_CREDENTIAL_USERNAME']
-os.environ['REDSHIFT_PASSWORD'] = os.environ['REDSHIFT_CREDENTIAL_PASSWORD']
-os.environ['S3_TEMP_BUCKET'] = 'parsons-tmc'
-
-
-# Set up environment and load credentials
-rs = Redshift()  # Redshift
-
-# Load google credentials for parsons
-creds = json.loads(os.environ['GOOGLE_JSON_CRED_PASSWORD'])  # Load JSON credentials
-parsons_sheets = GoogleSheets(google_keyfile_dict=creds)  # Initiate parsons GSheets class
-
-# Set up google sheets connection for gspread package
-scope = [
-    'https://spreadsheets.google.com/feeds',
-    'https://www.googleapis.com/auth/drive',
-]
-credentials = ServiceAccountCredentials.from_json_keyfile_dict(creds, scope)
-gspread_client = gspread.authorize(credentials)
-
 # Put HQ columns into a dictionary to make it easy to reference
 hidden_hq_columns = {
     'date_joined': 4, 'first_name': 0, 'last_name': 1, 'email': 2, 'phone': 3, 'total_signups': 5,
@@ -53,192 +38,794 @@ hidden_hq_columns = {
     'days_since_last_attendance': 10, 'status':11
 }
 
-# Get cron job spreadsheet
-hubs = parsons_sheets.get_worksheet('1ESXwSfjkDrgCRYrAag_SHiKCMIgcd1U3kz47KLNpGeA', 'cron job')
+# Fall back to matching HQ rows to Mobilize contacts on phone number when the email doesn't match
+MATCH_ON_PHONE = False
+
+# Mobilize attendance state, kept up to date incrementally so each run only reads the newest participations.
+# One row per deduped participation
+MOBILIZE_STATE_TABLE = 'sunrise.hub_hq_mobilize_participations'
+# One row per hub email and contact email, with the fields the HQ needs
+MOBILIZE_AGGREGATES_TABLE = 'sunrise.hub_hq_mobilize_aggregates'
+# Newest participation folded into the state for each hub, and when the hub's state was last rebuilt
+MOBILIZE_WATERMARKS_TABLE = 'sunrise.hub_hq_mobilize_watermarks'
+# Participations created or with an event up to this many days before the watermark are read again, to pick up
+# attendance that's marked after the event
+MOBILIZE_LOOKBACK_DAYS = 30
+# Rebuild each hub's state from its full history at least this often, to pick up anything the lookback missed
+MOBILIZE_FULL_REFRESH_DAYS = 7
+# Hubs with at least this many Mobilize contacts or Hidden HQ rows are processed in streaming mode: Mobilize rows are
+# streamed from Redshift into compact MobilizeRows stores, and the Hidden HQ is read and written in windows of
+# HQ_WINDOW_ROWS rows, so memory stays flat however big the hub is
+STREAMING_ROW_THRESHOLD = 100000
 
-# Create errors list of lists to populate and push to redshift at the end
-hq_errors =[['date', 'script', 'hub', 'error', 'traceback', 'other_messages']]
 
 def connect_to_hq(hub: dict):
     """
     Connect to HQ worksheet for hub
     :param hub: dictionary for that hub from set up sheet, retrieved by parsons
-    :return: A worksheet object of gspread class worksheet
+    :return: A HiddenHQ handle, which opens the gspread worksheet the first time it's used
     """
-    # connect to spreadsheet with spread
-    spreadsheet = gspread_client.open_by_key(hub['spreadsheet_id'])
-    # Get Hidden HQ as list of lists
-    hidden_hq_worksheet = spreadsheet.worksheet('Hidden HQ')
-    return hidden_hq_worksheet
+    return HiddenHQ(clients.gspread_client, hub['spreadsheet_id'])
 
 
-def get_mobilize_data(hub: dict):
+def sql_hub_email_list(hub_emails: list):
     """
-    Get Mobilize event attendance data for hub
-    :param hub: dictionary for that hub from set up sheet, retrieved by parsons
-    :return: A dictionary of dictionaries where each key is a unique email and each item is a row of info from Mobilize
+    Quote hub emails for a SQL in (...) list
+    :param hub_emails: list of hub emails (the Mobilize event creator email for each hub)
+    :return: comma separated string of quoted, lowercase hub emails
     """
-    # Get Mobilize data -- query returns a table of deduped contacts and their event attendance history
-    event_attendance_sql = f'''
-with 
--- deals with duplicate
-most_recent as 
+    # Hub emails are matched case insensitively, so lower them here and in the queries
+    return ', '.join("'" + email.lower().replace("'", "''") + "'" for email in hub_emails)
+
+
+def refresh_attendance_state_sql(hub_emails: list):
+    """
+    Build the SQL that brings the Mobilize attendance state tables up to date for one or more hubs. Only participations
+    created (or with an event start) since the hub's watermark, less MOBILIZE_LOOKBACK_DAYS to catch late attendance
+    updates, are read from sunrise_mobilize. Their rows in MOBILIZE_STATE_TABLE are replaced, and the aggregates of the
+    (hub email, email) keys they touch are recomputed in MOBILIZE_AGGREGATES_TABLE. Hubs without a watermark, or whose
+    last full rebuild is older than MOBILIZE_FULL_REFRESH_DAYS, are rebuilt from their full history
+    :param hub_emails: list of hub emails (the Mobilize event creator email for each hub)
+    :return: SQL string of statements to run in one transaction. It returns no rows
+    """
+    hub_email_list = sql_hub_email_list(hub_emails)
+    hubs = '\nunion all\n'.join(f'''select {hub_email} as hub_email''' for hub_email in hub_email_list.split(', '))
+    return f'''
+create table if not exists {MOBILIZE_STATE_TABLE} (
+    participation_id bigint,
+    hub_email varchar(256),
+    email varchar(256),
+    first_name varchar(256),
+    last_name varchar(256),
+    phone_number varchar(256),
+    created_date timestamp,
+    start_date timestamp,
+    attended boolean
+);
+
+create table if not exists {MOBILIZE_AGGREGATES_TABLE} (
+    hub_email varchar(256),
+    email varchar(256),
+    first_name varchar(256),
+    last_name varchar(256),
+    phone varchar(256),
+    date_joined timestamp,
+    total_signups integer,
+    total_attendances integer,
+    first_signup date,
+    first_attendance date,
+    last_signup date,
+    last_attendance date
+);
+
+create table if not exists {MOBILIZE_WATERMARKS_TABLE} (
+    hub_email varchar(256),
+    watermark timestamp,
+    refreshed_at timestamp
+);
+
+-- hubs being refreshed
+create temp table refresh_hubs as
+{hubs};
+
+-- hubs without state, or due for a full rebuild
+create temp table full_refresh_hubs as
+select hub_email from refresh_hubs
+where hub_email not in
+(
+    select hub_email from {MOBILIZE_WATERMARKS_TABLE}
+    where refreshed_at >= dateadd(day, -{MOBILIZE_FULL_REFRESH_DAYS}, getdate())
+);
+
+-- participations since each hub's watermark, deduped the same way as the full history. Emails are normalized so
+-- sign ups whose emails only differ by case or whitespace count towards the same contact
+create temp table changed_participations as
+select hub_email, participation_id, email, first_name, last_name, phone_number, created_date, start_date, attended
+from
 (
     select
-        ppl.created_date,
-  		ppl.user_id as person_id, 
+        lower(events.creator__email_address) as hub_email,
+        ppl.id as participation_id,
+        lower(trim(ppl.user__email_address)) as email,
         ppl.user__given_name as first_name,
         ppl.user__family_name as last_name,
-        ppl.user__email_address as email,
         ppl.user__phone_number as phone_number,
-        ppl.status,
-        ppl.timeslot_id,
-        ppl.event_id,
-        ppl.attended,
+        ppl.created_date,
         ppl.start_date,
-  		events.id,
-  		events.title,
+        ppl.attended,
         row_number() over (partition by ppl.id order by ppl.created_date::date desc) = 1 as is_most_recent
-  	from sunrise_mobilize.participations ppl
+    from sunrise_mobilize.participations ppl
     left join sunrise_mobilize.events events on ppl.event_id = events.id
-    where events.creator__email_address ilike '{hub['hub_email']}'
-),
+    left join {MOBILIZE_WATERMARKS_TABLE} watermarks
+        on watermarks.hub_email = lower(events.creator__email_address)
+    where lower(events.creator__email_address) in ({hub_email_list})
+    and
+    (
+        lower(events.creator__email_address) in (select hub_email from full_refresh_hubs)
+        or ppl.created_date >= dateadd(day, -{MOBILIZE_LOOKBACK_DAYS}, watermarks.watermark)
+        or ppl.start_date >= dateadd(day, -{MOBILIZE_LOOKBACK_DAYS}, watermarks.watermark)
+    )
+) recent
+where is_most_recent = true;
 
+-- keys whose aggregates change: the keys of changed participations before and after the change, and every key of the
+-- hubs being rebuilt
+create temp table touched_keys as
+select hub_email, email from changed_participations
+union
+select state.hub_email, lower(trim(state.email))
+from {MOBILIZE_STATE_TABLE} state
+join changed_participations changed on state.participation_id = changed.participation_id
+union
+select hub_email, lower(trim(email)) from {MOBILIZE_STATE_TABLE}
+where hub_email in (select hub_email from full_refresh_hubs);
 
---Get unique signups
-signups as
-(
-    select * from most_recent where is_most_recent = true
-)
+delete from {MOBILIZE_STATE_TABLE}
+where hub_email in (select hub_email from full_refresh_hubs);
 
--- get unique people rows from signups
-select 
-    max(first_name) as first_name,
-    max(last_name) as last_name,
-    email,
-    max(phone_number) as phone,
-    min(created_date)::text as date_joined,
+delete from {MOBILIZE_STATE_TABLE}
+using changed_participations
+where {MOBILIZE_STATE_TABLE}.participation_id = changed_participations.participation_id;
+
+insert into {MOBILIZE_STATE_TABLE}
+select participation_id, hub_email, email, first_name, last_name, phone_number, created_date, start_date, attended
+from changed_participations;
+
+delete from {MOBILIZE_AGGREGATES_TABLE}
+using touched_keys
+where {MOBILIZE_AGGREGATES_TABLE}.hub_email = touched_keys.hub_email
+and coalesce(lower(trim({MOBILIZE_AGGREGATES_TABLE}.email)), '') = coalesce(touched_keys.email, '');
+
+-- get unique people rows for each touched key
+insert into {MOBILIZE_AGGREGATES_TABLE}
+select
+    state.hub_email,
+    lower(trim(state.email)) as email,
+    max(state.first_name) as first_name,
+    max(state.last_name) as last_name,
+    max(state.phone_number) as phone,
+    min(state.created_date) as date_joined,
     count(*) as total_signups,
     sum
     (
-    case 
-        when attended = true then 1
+    case
+        when state.attended = true then 1
         else 0
     end
     ) as total_attendances,
-    min(start_date::date)::text as first_signup,
+    min(state.start_date::date) as first_signup,
     min
         (
-        case 
-            when attended = true then start_date::date
+        case
+            when state.attended = true then state.start_date::date
             else null
         end
-        )::text as first_attendance,
-    datediff(day,max(start_date)::date,getdate()) as days_since_last_signup,
-    datediff
+        ) as first_attendance,
+    max(state.start_date::date) as last_signup,
+    max
         (
-        day
-        ,max
-            (
-            case 
-                when attended = true then start_date
-                else null
-            end
-            )::date
-        ,getdate()) as days_since_last_attendance
-from signups
-group by email
-order by date_joined
+        case
+            when state.attended = true then state.start_date::date
+            else null
+        end
+        ) as last_attendance
+from {MOBILIZE_STATE_TABLE} state
+join touched_keys
+    on state.hub_email = touched_keys.hub_email
+    and coalesce(lower(trim(state.email)), '') = coalesce(touched_keys.email, '')
+group by state.hub_email, lower(trim(state.email));
+
+-- move each hub's watermark up to its newest participation
+create temp table new_watermarks as
+select
+    refresh_hubs.hub_email,
+    max(state.created_date) as watermark,
+    case
+        when max(full_refresh_hubs.hub_email) is not null then getdate()
+        else max(old.refreshed_at)
+    end as refreshed_at
+from refresh_hubs
+join {MOBILIZE_STATE_TABLE} state on state.hub_email = refresh_hubs.hub_email
+left join full_refresh_hubs on full_refresh_hubs.hub_email = refresh_hubs.hub_email
+left join {MOBILIZE_WATERMARKS_TABLE} old on old.hub_email = refresh_hubs.hub_email
+group by refresh_hubs.hub_email;
+
+delete from {MOBILIZE_WATERMARKS_TABLE}
+where hub_email in (select hub_email from refresh_hubs);
+
+insert into {MOBILIZE_WATERMARKS_TABLE}
+select hub_email, watermark, refreshed_at from new_watermarks;
 '''
-    # Send query to mobilize
-    mobilize_data = rs.query(sql=event_attendance_sql)
-    if mobilize_data.num_rows == 0:
-        return
-    # Store mobilize rows in a dictionary where each row's key is an email (used for matching)
-    else:
-        mobilize_dict = {i['email']: i for i in mobilize_data}
-        return mobilize_dict
 
 
-def mobilize_updates(hub: dict, mobilize_dict: dict, hidden_hq: list, hidden_hq_worksheet, hidden_hq_columns):
+def event_attendance_sql(hub_emails: list):
+    """
+    Build the Mobilize event attendance query for one or more hubs. It reads the aggregates kept up to date by
+    refresh_attendance_state_sql, combining any whose emails only differ by case or whitespace so each contact comes
+    back once; the days since fields are worked out from the stored dates when the query runs
+    :param hub_emails: list of hub emails (the Mobilize event creator email for each hub)
+    :return: SQL string that returns a table of deduped contacts and their event attendance history, partitioned by
+    hub email
     """
-    Each row/list from the HQ is checked for a match in the mobilize data using email. A new list of lists is created
-    where each list is a person's event attendance record from mobilize. If there is an email match then the resulting
-    list/row for that contact contains event attendance data and the row for that contact is removed  from the mobilize
-    data dictionary (which we append to Hidden HQ later). If there is no match, then the resulting row/list will have
-    four empty values. The rows/lists are ordered within the outer list exactly how the Hidden HQ is ordered so that we
-    can push the list back to the HQ and have each event attendance record line up with the correct contact in the
-    hidden HQ. Finally the updates are pushed to the Hidden HQ and the mobilize rows for which there were no matches in
-    the HQ are returned as a parson's table
+    return f'''
+select
+    hub_email,
+    max(first_name) as first_name,
+    max(last_name) as last_name,
+    lower(trim(email)) as email,
+    max(phone) as phone,
+    min(date_joined)::text as date_joined,
+    sum(total_signups) as total_signups,
+    sum(total_attendances) as total_attendances,
+    min(first_signup)::text as first_signup,
+    min(first_attendance)::text as first_attendance,
+    datediff(day, max(last_signup), getdate()) as days_since_last_signup,
+    datediff(day, max(last_attendance), getdate()) as days_since_last_attendance
+from {MOBILIZE_AGGREGATES_TABLE}
+where hub_email in ({sql_hub_email_list(hub_emails)})
+group by hub_email, lower(trim(email))
+order by hub_email, date_joined
+'''
+
+
+def hub_activity_sql(hub_emails: list):
+    """
+    Build the query that summarizes each hub's Mobilize participations, to tell which hubs have new sign ups or
+    attendance since they were last synced
+    :param hub_emails: list of hub emails (the Mobilize event creator email for each hub)
+    :return: SQL string that returns one row per hub email
+    """
+    return f'''
+select
+    lower(events.creator__email_address) as hub_email,
+    max(ppl.created_date)::text as latest_participation,
+    count(*) as participations,
+    sum
+    (
+    case
+        when ppl.attended = true then 1
+        else 0
+    end
+    ) as attendances
+from sunrise_mobilize.participations ppl
+left join sunrise_mobilize.events events on ppl.event_id = events.id
+where lower(events.creator__email_address) in ({sql_hub_email_list(hub_emails)})
+group by lower(events.creator__email_address)
+'''
+
+
+def get_hub_activity(hubs):
+    """
+    Get a summary of each hub's Mobilize participations (newest participation, number of participations and number
+    attended) with one grouped query. A hub's summary only changes when it has new sign ups or attendance is marked
+    :param hubs: iterable of hub dictionaries from set up sheet, retrieved by parsons
+    :return: dictionary of activity strings keyed by lowercase hub email. Hubs without Mobilize data are left out
+    """
+    hub_emails = sorted({hub['hub_email'] for hub in hubs if hub['hub_email']})
+    if not hub_emails:
+        return {}
+    with metrics.stage('redshift_query'):
+        activity = clients.rs.query(sql=hub_activity_sql(hub_emails))
+        metrics.add(api_calls=1)
+    if activity is None:
+        return {}
+    return {row['hub_email']: f'''{row['latest_participation']}|{row['participations']}|{row['attendances']}'''
+            for row in activity}
+
+
+def hub_activity_changed(hub: dict, hub_activity: dict):
+    """
+    Check whether a hub has Mobilize activity that hasn't been synced to its HQ yet
+    :param hub: dictionary for that hub from set up sheet, retrieved by parsons
+    :param hub_activity: output of get_hub_activity
+    :return: True if the hub's activity is different from its last sync (or it hasn't been synced before)
+    """
+    sync_state = clients.sync_state.load('mobilize_script', hub['spreadsheet_id'])
+    return sync_state is None or sync_state['activity'] != hub_activity.get((hub['hub_email'] or '').lower())
+
+
+def hub_contacts_sql(hub_emails: list):
+    """
+    Build the query that counts each hub's Mobilize contacts, to decide which hubs to stream
+    :param hub_emails: list of hub emails (the Mobilize event creator email for each hub)
+    :return: SQL string that returns one row per hub email with the column contacts
+    """
+    return f'''
+select hub_email, count(*) as contacts
+from {MOBILIZE_AGGREGATES_TABLE}
+where hub_email in ({sql_hub_email_list(hub_emails)})
+group by hub_email
+'''
+
+
+def get_all_mobilize_data(hubs, refresh_hub_emails: list = None, streaming: bool = None):
+    """
+    Get Mobilize event attendance data for every hub with a single query instead of one query per hub
+    :param hubs: iterable of hub dictionaries from set up sheet, retrieved by parsons
+    :param refresh_hub_emails: optional list of the hub emails whose attendance state needs refreshing, e.g. the hubs
+    with new activity. Defaults to every hub
+    :param streaming: if True, stream every hub's rows from Redshift into a MobilizeRows store per hub instead of
+    loading them into a parsons table; if False, stream none. Defaults to streaming only the hubs with
+    STREAMING_ROW_THRESHOLD or more Mobilize contacts
+    :return: A dictionary keyed by lowercase hub email where each item is a dictionary of dictionaries keyed by unique
+    email (the same shape get_mobilize_data returns for a single hub), or a MobilizeRows store for streamed hubs. Hubs
+    without Mobilize data are left out.
+    """
+    hub_emails = sorted({hub['hub_email'] for hub in hubs if hub['hub_email']})
+    if not hub_emails:
+        return {}
+    if refresh_hub_emails is None:
+        refresh_hub_emails = hub_emails
+    # Fold the newest Mobilize participations into the attendance state, then read the hubs' aggregates
+    with metrics.stage('redshift_query'):
+        if refresh_hub_emails:
+            clients.rs.query(sql=refresh_attendance_state_sql(refresh_hub_emails))
+            metrics.add(api_calls=1)
+        if streaming is None:
+            hub_contacts = clients.rs.query(sql=hub_contacts_sql(hub_emails))
+            metrics.add(api_calls=1)
+            streamed_hub_emails = sorted(row['hub_email'] for row in (hub_contacts or [])
+                                         if row['contacts'] >= STREAMING_ROW_THRESHOLD)
+        else:
+            streamed_hub_emails = hub_emails if streaming else []
+        # Only the big hubs are streamed, and so processed in windows; the rest are loaded into dictionaries
+        all_mobilize_dicts = stream_mobilize_data(streamed_hub_emails) if streamed_hub_emails else {}
+        loaded_hub_emails = [hub_email for hub_email in hub_emails if hub_email not in streamed_hub_emails]
+        if not loaded_hub_emails:
+            return all_mobilize_dicts
+        mobilize_data = clients.rs.query(sql=event_attendance_sql(loaded_hub_emails))
+        metrics.add(api_calls=1, rows=0 if mobilize_data is None else mobilize_data.num_rows)
+    if mobilize_data is None:
+        return all_mobilize_dicts
+    # Split rows out by hub, storing each hub's rows in a dictionary where each row's key is an email (used for
+    # matching). Rows are ordered by date joined within each hub, same as the single hub query.
+    for row in mobilize_data:
+        hub_email = row.pop('hub_email')
+        all_mobilize_dicts.setdefault(hub_email, {})[row['email']] = row
+    return all_mobilize_dicts
+
+
+def stream_mobilize_data(hub_emails: list):
+    """
+    Stream Mobilize event attendance data for every hub from Redshift into a MobilizeRows store per hub, so neither the
+    full result nor a dictionary per contact is ever held in memory
+    :param hub_emails: list of hub emails (the Mobilize event creator email for each hub)
+    :return: A dictionary of MobilizeRows keyed by lowercase hub email. Hubs without Mobilize data are left out
+    """
+    all_mobilize_rows = {}
+    rows = 0
+    # Rows come ordered by hub email, then date joined, so each store gets its rows in date joined order
+    for row in stream_query(event_attendance_sql(hub_emails)):
+        all_mobilize_rows.setdefault(row.pop('hub_email'), MobilizeRows()).append(row)
+        rows += 1
+    metrics.add(rows=rows)
+    return {hub_email: mobilize_rows.freeze() for hub_email, mobilize_rows in all_mobilize_rows.items()}
+
+
+def get_mobilize_data(hub: dict, all_mobilize_dicts: dict = None):
+    """
+    Get Mobilize event attendance data for hub
+    :param hub: dictionary for that hub from set up sheet, retrieved by parsons
+    :param all_mobilize_dicts: optional output of get_all_mobilize_data. When given, the hub's rows are taken from it
+    instead of querying Redshift for this hub alone
+    :return: A dictionary of dictionaries where each key is a unique email and each item is a row of info from Mobilize
+    """
+    if all_mobilize_dicts is None:
+        all_mobilize_dicts = get_all_mobilize_data([hub])
+    # Return None when there is no mobilize data for the hub
+    return all_mobilize_dicts.get(hub['hub_email'].lower())
+
+
+def cell_value(value):
+    """
+    Normalize a value to how it reads back from the sheet with get_all_values, so computed values can be compared with
+    values fetched from the HQ
+    :param value: value from the sheet or from Mobilize
+    :return: string version of the value
+    """
+    if value is None:
+        return ''
+    return str(value)
+
+
+def hq_cell_updates(original_rows: list, updated_rows: list, first_row: int, first_column: int):
+    """
+    Compare the values fetched from the HQ with the computed values and build the ranges that actually changed. Changed
+    cells that are next to each other in a row become one range, and rows that change the same columns one after
+    another are merged into one block
+    :param original_rows: list of lists of values as they were fetched from the sheet
+    :param updated_rows: list of lists of computed values, lined up with original_rows
+    :param first_row: sheet row number (1-based) of the first row in the lists
+    :param first_column: sheet column number (1-based) of the first value in each row
+    :return: tuple of (list of {'range': ..., 'values': ...} dictionaries for worksheet.batch_update, cells changed)
+    """
+    # Find runs of changed cells in each row as (row number, first column index, last column index, values)
+    runs = []
+    for row_offset, (original_row, updated_row) in enumerate(zip(original_rows, updated_rows)):
+        run_start = None
+        for column_index, value in enumerate(updated_row + [None]):
+            changed = column_index < len(updated_row) and \
+                (column_index >= len(original_row) or cell_value(original_row[column_index]) != cell_value(value))
+            if changed and run_start is None:
+                run_start = column_index
+            elif not changed and run_start is not None:
+                runs.append([first_row + row_offset, run_start, column_index - 1,
+                             [updated_row[run_start:column_index]]])
+                run_start = None
+
+    # Merge runs on consecutive rows that cover the same columns into blocks. A row can have several runs, so the open
+    # block for each (first column, last column) is tracked separately
+    blocks = []
+    open_blocks = {}
+    for run in runs:
+        previous = open_blocks.get((run[1], run[2]))
+        if previous and previous[0] + len(previous[3]) == run[0]:
+            previous[3].extend(run[3])
+        else:
+            blocks.append(run)
+            open_blocks[(run[1], run[2])] = run
+
+    cell_updates = []
+    cells_changed = 0
+    for row_number, start, end, values in blocks:
+        cell_updates.append({
+            'range': f'''{column_letter(first_column + start)}{row_number}:{column_letter(first_column + end)}'''
+                     f'''{row_number + len(values) - 1}''',
+            'values': values
+        })
+        cells_changed += (end - start + 1) * len(values)
+    return cell_updates, cells_changed
+
+
+def normalize_phone(phone):
+    """
+    Normalize a phone number for matching to its last 10 digits
+    :param phone: phone number in any format (or None)
+    :return: string of 10 digits, or an empty string if the number is too short to match on
+    """
+    digits = re.sub(r'\D', '', str(phone or ''))
+    return digits[-10:] if len(digits) >= 10 else ''
+
+
+def email_hash(key: str):
+    """
+    64 bit hash of a normalized email or phone number, for MobilizeRows' sorted indexes
+    :param key: normalized email or phone number
+    :return: signed 64 bit integer
+    """
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+
+
+class MobilizeRows(Mapping):
+    """
+    Compact, array backed store of one hub's Mobilize rows, for hubs too big to hold as a dictionary of dictionaries.
+    Text fields are packed into one byte buffer and counts into arrays of floats, and rows are looked up through a
+    sorted array of email hashes. Rows are added with append in date joined order, then indexed with freeze. Once
+    frozen it's a read only mapping of email to row dictionary, like the dictionaries get_mobilize_data returns, so
+    either can be passed around. Only the first row for each email is part of the mapping; row_count and row also
+    cover the later duplicates
+    """
+    text_columns = ('first_name', 'last_name', 'email', 'phone', 'date_joined', 'first_signup', 'first_attendance')
+    number_columns = ('total_signups', 'total_attendances', 'days_since_last_signup', 'days_since_last_attendance')
+
+    def __init__(self):
+        self._text = bytearray()
+        self._offsets = array('Q', [0])
+        self._numbers = {column: array('d') for column in self.number_columns}
+        self._email_hashes = array('q')
+        self._blank_emails = array('b')
+        self._sorted_hashes = None
+        self._sorted_rows = None
+        self._phone_index = None
+        # Rows that are the first (earliest joined) for their normalized email. Later duplicates are never matched
+        # or appended
+        self.unique = None
+        self.duplicate_emails = 0
+
+    def append(self, row: dict):
+        """
+        Add a row from the Mobilize query
+        :param row: dictionary with the text_columns and number_columns
+        :return: None
+        """
+        # None is stored as NUL, so it comes back as None rather than ''
+        self._text += '\x1f'.join('\x00' if row[column] is None else str(row[column])
+                                  for column in self.text_columns).encode('utf-8')
+        self._offsets.append(len(self._text))
+        for column in self.number_columns:
+            self._numbers[column].append(np.nan if row[column] is None else float(row[column]))
+        key = normalize_email(row['email'])
+        self._email_hashes.append(email_hash(key))
+        self._blank_emails.append(0 if key else 1)
+
+    def freeze(self):
+        """
+        Build the email index once every row has been added
+        :return: self
+        """
+        hashes = np.frombuffer(self._email_hashes, dtype=np.int64)
+        blank = np.frombuffer(self._blank_emails, dtype=np.int8).astype(bool)
+        # Stable sort keeps rows with the same email in date joined order, so the first of each run is the earliest
+        order = np.argsort(hashes, kind='stable')
+        order = order[~blank[order]]
+        sorted_hashes = hashes[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = sorted_hashes[1:] != sorted_hashes[:-1]
+        self._sorted_hashes = sorted_hashes[first]
+        self._sorted_rows = order[first]
+        self.unique = np.zeros(self.row_count, dtype=bool)
+        self.unique[self._sorted_rows] = True
+        self.duplicate_emails = int((~first).sum())
+        return self
+
+    def _lookup(self, hashes, sorted_hashes, sorted_rows):
+        hashes = np.asarray(hashes, dtype=np.int64)
+        if not len(sorted_hashes):
+            return np.full(len(hashes), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(sorted_hashes, hashes), len(sorted_hashes) - 1)
+        return np.where(sorted_hashes[positions] == hashes, sorted_rows[positions], -1)
+
+    def lookup(self, keys: list):
+        """
+        Find the rows for normalized emails
+        :param keys: list of normalized emails
+        :return: numpy array of row numbers, -1 where there's no row (or the email is blank)
+        """
+        indices = self._lookup([email_hash(key) for key in keys], self._sorted_hashes, self._sorted_rows)
+        return np.where([bool(key) for key in keys], indices, -1) if len(keys) else indices
+
+    def lookup_phones(self, phones: list):
+        """
+        Find the rows for normalized phone numbers. Phone numbers shared by more than one Mobilize contact aren't
+        matched
+        :param phones: list of normalized phone numbers
+        :return: numpy array of row numbers, -1 where there's no row
+        """
+        if self._phone_index is None:
+            rows = self._sorted_rows
+            phones_by_row = [normalize_phone(self.row(i)['phone']) for i in rows]
+            hashes = np.array([email_hash(phone) for phone in phones_by_row], dtype=np.int64)
+            has_phone = np.array([bool(phone) for phone in phones_by_row], dtype=bool)
+            hashes, rows = hashes[has_phone], rows[has_phone]
+            order = np.argsort(hashes, kind='stable')
+            hashes, rows = hashes[order], rows[order]
+            unique_hashes, counts = np.unique(hashes, return_counts=True)
+            keep = np.isin(hashes, unique_hashes[counts == 1])
+            self._phone_index = (hashes[keep], rows[keep])
+        indices = self._lookup([email_hash(phone) for phone in phones], *self._phone_index)
+        return np.where([bool(phone) for phone in phones], indices, -1) if len(phones) else indices
+
+    def row(self, i: int):
+        """
+        Get a row by its row number
+        :param i: row number, in the order rows were added
+        :return: dictionary with the text_columns and number_columns
+        """
+        values = self._text[self._offsets[i]:self._offsets[i + 1]].decode('utf-8').split('\x1f')
+        row = {column: None if value == '\x00' else value for column, value in zip(self.text_columns, values)}
+        for column in self.number_columns:
+            number = self._numbers[column][i]
+            row[column] = None if np.isnan(number) else int(number)
+        return row
+
+    def __getitem__(self, email: str):
+        index = self.lookup([normalize_email(email)])[0]
+        if index < 0:
+            raise KeyError(email)
+        return self.row(index)
+
+    @property
+    def row_count(self):
+        """
+        Number of rows added, including rows whose email is blank or already used by an earlier row
+        """
+        return len(self._offsets) - 1
+
+    def __iter__(self):
+        for i in np.flatnonzero(self.unique):
+            yield self.row(i)['email']
+
+    def __len__(self):
+        return len(self._sorted_rows)
+
+
+def join_hq_to_mobilize(hidden_hq: list, mobilize_dict: dict, hidden_hq_columns: dict,
+                        match_on_phone: bool = MATCH_ON_PHONE):
+    """
+    Match HQ rows to Mobilize rows in one pass using an index of normalized emails (and optionally normalized phone
+    numbers for HQ rows whose email doesn't match). Every HQ row with a matching email gets that Mobilize row, so
+    duplicate HQ rows for the same person are all kept up to date. event_attendance_sql already combines sign ups whose
+    emails only differ by case or whitespace; if a mobilize_dict still has several rows for one normalized email, the
+    first (earliest joined) is used and the rest are counted as duplicates
+    :param hidden_hq: a list of lists, where each inner list is a row from the hub's HQ
+    :param mobilize_dict: dictionary of mobilize data where each key is a unique email
+    :param hidden_hq_columns: dictionary indicating the index of each HQ column in the actual spreadsheet
+    :param match_on_phone: if True, fall back to matching on phone number when the email doesn't match
+    :return: tuple of (list of (hq_row, mobilize_row) matches, dictionary of the Mobilize rows without a match keyed by
+    email, dictionary of counts: duplicate_hq_emails, duplicate_mobilize_emails, phone_matches)
+    """
+    # Build the index of normalized email -> Mobilize row
+    email_index = {}
+    duplicate_mobilize_emails = 0
+    for email, mobilize_row in mobilize_dict.items():
+        key = normalize_email(email)
+        if key in email_index:
+            duplicate_mobilize_emails += 1
+        elif key:
+            email_index[key] = email
+    phone_index = {}
+    if match_on_phone:
+        # Phone numbers shared by more than one Mobilize contact can't be matched on
+        ambiguous_phones = set()
+        for key, email in email_index.items():
+            phone = normalize_phone(mobilize_dict[email]['phone'])
+            if phone in phone_index:
+                ambiguous_phones.add(phone)
+            elif phone:
+                phone_index[phone] = key
+        for phone in ambiguous_phones:
+            del phone_index[phone]
+
+    matches = []
+    matched_keys = set()
+    hq_keys = set()
+    duplicate_hq_emails = 0
+    phone_matches = 0
+    for hq_row in hidden_hq:
+        key = normalize_email(hq_row[hidden_hq_columns['email']])
+        if key and key in hq_keys:
+            duplicate_hq_emails += 1
+        hq_keys.add(key)
+        if key not in email_index and match_on_phone:
+            phone_key = phone_index.get(normalize_phone(hq_row[hidden_hq_columns['phone']]))
+            if phone_key is not None:
+                key = phone_key
+                phone_matches += 1
+        if key not in email_index:
+            continue
+        matches.append((hq_row, mobilize_dict[email_index[key]]))
+        matched_keys.add(key)
+
+    unmatched_mobilize = {email: mobilize_dict[email] for key, email in email_index.items() if key not in matched_keys}
+    counts = {'duplicate_hq_emails': duplicate_hq_emails, 'duplicate_mobilize_emails': duplicate_mobilize_emails,
+              'phone_matches': phone_matches}
+    return matches, unmatched_mobilize, counts
+
+
+def classify_statuses(date_joined: list, total_signups: list, days_since_last_signup: list, now: datetime.datetime):
+    """
+    Assign a member status to each contact from their event sign up metrics, using array operations instead of a
+    per-contact if/elif ladder:
+    - HOT LEAD: joined in the last 7 days
+    - Prospective/New Member: joined 7 to 60 days ago
+    - Active Member: more than 2 sign ups and signed up in the last 60 days
+    - Inactive Member: more than 2 sign ups but none in the last 60 days
+    - Never got involved: 2 or fewer sign ups and joined more than 60 days ago
+    :param date_joined: list of date joined strings from Mobilize, one per contact
+    :param total_signups: list of total sign ups, one per contact
+    :param days_since_last_signup: list of days since last sign up, one per contact
+    :param now: timezone aware datetime to measure time since joining from
+    :return: numpy array of statuses, lined up with the input lists
+    """
+    age = np.datetime64(now.astimezone(timezone.utc).replace(tzinfo=None), 'us') - parse_hq_dates(date_joined)
+    total_signups = np.array(total_signups, dtype=float)
+    days_since_last_signup = np.array(days_since_last_signup, dtype=float)
+    sevendays = np.timedelta64(7, 'D')
+    sixtydays = np.timedelta64(60, 'D')
+    conditions = [
+        age <= sevendays,
+        (sevendays < age) & (age <= sixtydays),
+        (total_signups > 2) & (days_since_last_signup < 60),
+        (total_signups > 2) & (days_since_last_signup >= 60),
+        (total_signups <= 2) & (age > sixtydays),
+    ]
+    statuses = ['HOT LEAD', 'Prospective/New Member', 'Active Member', 'Inactive Member', 'Never got involved']
+    return np.select(conditions, statuses, default='error')
+
+
+@timed('compute')
+def mobilize_updates(hub: dict, mobilize_dict: dict, hidden_hq: list, hidden_hq_worksheet, hidden_hq_columns,
+                     diff_writes: bool = True, writes: SheetWriteBatch = None):
+    """
+    Each row/list from the HQ is checked for a match in the mobilize data using normalized email (see
+    join_hq_to_mobilize). A new list of lists is created where each list is a person's event attendance record from
+    mobilize. If there is an email match then the resulting list/row for that contact contains event attendance data,
+    and mobilize rows that didn't match any HQ row are kept aside (which we append to Hidden HQ later). If there is no
+    match, then the resulting row/list will have four empty values. The rows/lists are ordered within the outer list
+    exactly how the Hidden HQ is ordered so that we can push the list back to the HQ and have each event attendance
+    record line up with the correct contact in the hidden HQ. Finally the updates are pushed to the Hidden HQ and the
+    mobilize rows for which there were no matches in the HQ are returned as a parson's table. In diff mode only the
+    cells that differ from what was fetched from the Hidden HQ are sent, in a single batch update. When a
+    SheetWriteBatch is passed in the updates are only queued on it, so the caller can send them with the hub's other
+    writes
     :param hub: dictionary for that hub from set up sheet, retrieved by parsons
     :param mobilize_dict: dictionary of mobilize data where each key is a unique email
     :param hidden_hq: a list of lists, where each innter list is a row from the hub's HQ
     :param hidden_hq_columns: dictionary indicating the index of each HQ column in the actual spreadsheet
     :param hidden_hq_worksheet: the hq worksheet, which is a gspread class of object
+    :param diff_writes: if True, only write changed cells. If False, rewrite F4:L for every row
+    :param writes: optional SheetWriteBatch to queue the updates on instead of sending them right away
     :return: A parson's table of mobilize records without matches in the HQ
     """
 
     # Create a list of the event sign up/attencance summary fields we're going to attenpt to update in the HQ
     update_items = list(hidden_hq_columns.keys())
     update_items = update_items[:hidden_hq_columns['status']]
-    # Open a list for the updates, which we will fill with lists, one for each contact.
-    event_attendance_updates = []
-    now = datetime.datetime.now(timezone.utc)
-    sevendays = datetime.timedelta(days=7)
-    sixtydays = datetime.timedelta(days=60)
-    # For each row in the hub_hq, if the email is in the mobilize data, then update the appropriate fields/items,
-    # otherwise,append a list of blank values
-    for hq_row in hidden_hq:
-        # Update Hidden HQ records that have a match in the retrieved mobilize data and remove from the mobilize data
-        try:
-            # Update each field/list item from the update_items for the match. This will create a whole update list/row
-            # substitute mobilize values for hq values
-            for i in update_items:
-                # If the email address of the hq row exists in the mobilize data, append the correct event attendance
-                # value to the list
-                hq_row[hidden_hq_columns[i]] = mobilize_dict[hq_row[hidden_hq_columns['email']]][i]
-            # Assign status based on event sign up metrics
-            # Start by getting date joined from HQ
-            date_joined = datetime.datetime.strptime(hq_row[hidden_hq_columns['date_joined']][:19] + ' +00:00',
-                                                     "%Y-%m-%d %H:%M:%S %z")
-            if now - date_joined <= sevendays:
-                status = 'HOT LEAD'
-            elif sevendays < now - date_joined <= sixtydays:
-                status = "Prospective/New Member"
-            elif mobilize_dict[hq_row[hidden_hq_columns['email']]]['total_signups'] > 2 and \
-                     mobilize_dict[hq_row[hidden_hq_columns['email']]]['days_since_last_signup'] < 60:
-                status = 'Active Member'
-            elif mobilize_dict[hq_row[hidden_hq_columns['email']]]['total_signups'] > 2 and \
-                     mobilize_dict[hq_row[hidden_hq_columns['email']]]['days_since_last_signup'] >= 60:
-                status = 'Inactive Member'
-            elif mobilize_dict[hq_row[hidden_hq_columns['email']]]['total_signups'] <= 2 and now - date_joined > sixtydays:
-                status = 'Never got involved'
-            else:
-                status = 'error'
-            hq_row[hidden_hq_columns['status']] = status
-            # Reduce to fields that need to be updated
-            update_row = hq_row[hidden_hq_columns['total_signups']:hidden_hq_columns['status']+1]
-            # Add to the update list of lists
-            event_attendance_updates.append(update_row)
-            # Remove contact from mobilize parson's table dictionary, which will be appended to hidden hq sheet
-            del mobilize_dict[hq_row[hidden_hq_columns['email']]]
-        # When no match is found, create a list/row with empty values/just retain the value on record (which are empty)
-
-        except KeyError:
-            event_attendance_updates.append(hq_row[hidden_hq_columns['total_signups']:
-                                                   hidden_hq_columns['days_since_last_attendance'] + 1])
-    # Send the updates to Hidden HQ
-    hidden_hq_worksheet.update('F4:L', event_attendance_updates)
+    first_column, status_column = hidden_hq_columns['total_signups'], hidden_hq_columns['status']
+    # Keep the event attendance values as they were fetched from the HQ so we can tell which cells changed
+    original_values = [hq_row[first_column:status_column + 1] for hq_row in hidden_hq]
+
+    metrics.add(rows=len(hidden_hq))
+    # Join HQ rows to the mobilize data once on normalized email (and phone, if turned on)
+    matches, unmatched_mobilize, join_counts = join_hq_to_mobilize(hidden_hq, mobilize_dict, hidden_hq_columns)
+    logger.info(f'''{hub['hub_name']}: {len(matches)} HQ rows matched ({join_counts['phone_matches']} on phone), '''
+                f'''{len(unmatched_mobilize)} new Mobilize contacts, {join_counts['duplicate_hq_emails']} duplicate '''
+                f'''HQ emails, {join_counts['duplicate_mobilize_emails']} duplicate Mobilize emails''')
+    matched_rows = [hq_row for hq_row, mobilize_row in matches]
+    matched_mobilize_rows = [mobilize_row for hq_row, mobilize_row in matches]
+    for hq_row, mobilize_row in matches:
+        # Substitute mobilize values for hq values
+        for i in update_items:
+            hq_row[hidden_hq_columns[i]] = mobilize_row[i]
+
+    # Assign status based on event sign up metrics for every matched row at once
+    statuses = classify_statuses([row['date_joined'] for row in matched_mobilize_rows],
+                                 [row['total_signups'] for row in matched_mobilize_rows],
+                                 [row['days_since_last_signup'] for row in matched_mobilize_rows],
+                                 datetime.datetime.now(timezone.utc))
+    for hq_row, status in zip(matched_rows, statuses):
+        hq_row[status_column] = str(status)
+
+    # Build the list of updates, one for each contact, ordered exactly like the Hidden HQ. Matched rows update through
+    # status, rows without a match just retain the values on record
+    matched_ids = {id(hq_row) for hq_row in matched_rows}
+    event_attendance_updates = [
+        hq_row[first_column:status_column + 1] if id(hq_row) in matched_ids
+        else hq_row[first_column:hidden_hq_columns['days_since_last_attendance'] + 1]
+        for hq_row in hidden_hq
+    ]
+    # Send the updates to Hidden HQ, or queue them if the caller is batching the hub's writes
+    flush = writes is None
+    if flush:
+        writes = SheetWriteBatch(hidden_hq_worksheet)
+    if diff_writes:
+        cell_updates, cells_changed = hq_cell_updates(original_values, event_attendance_updates, first_row=4,
+                                                      first_column=hidden_hq_columns['total_signups'] + 1)
+        writes.batch_update(cell_updates)
+        logger.info(f'''{cells_changed} Hidden HQ cells to write in {len(cell_updates)} ranges for {hub['hub_name']}''')
+    else:
+        writes.update('F4:L', event_attendance_updates)
+    if flush:
+        writes.flush()
 
     # Now we convert the remaining Mobilize records, for which no matches were found, and reformat them to a parson's
-    # table so that we can append them to the google sheet using the parson's google sheet append method. We also add a
-    # value of 'Mobilize' for the source column
+    # table so that we can append them to the google sheet. Its rows line up with the HQ columns
 
-    # Convert remainder of mobilize dictionary rows to lists, which will be converted to a parsons table
+    # Convert unmatched mobilize rows to lists, which will be converted to a parsons table
     columns_to_append = ['first_name', 'last_name', 'email', 'phone', 'date_joined', 'total_signups',
                          'total_attendances', 'first_signup', 'first_attendance', 'days_since_last_signup', 'days_since_last_attendance']
     # create list of lists
-    mobilize_data_append = [[mobilize_dict[i][value] for value in columns_to_append] for i in mobilize_dict]
+    mobilize_data_append = [[unmatched_mobilize[i][value] for value in columns_to_append] for i in unmatched_mobilize]
     # insert column headers
     mobilize_data_append.insert(0,['date_joined', 'first_name', 'last_name', 'email', 'phone', 'total_signups',
                          'total_attendances', 'first_signup', 'first_attendance', 'days_since_last_signup', 'days_since_last_attendance'])
@@ -250,52 +837,224 @@ def mobilize_updates(hub: dict, mobilize_dict: dict, hidden_hq: list, hidden_hq_
     mobilize_parsons_append.add_column('status','HOT LEAD')
     return mobilize_parsons_append
 
-def main():
-    for hub in hubs:
-        # Connect to the hub's spreadsheet
-        hidden_hq_worksheet = connect_to_hq(hub)
-        # Get hidden hq table
-        hidden_hq = hidden_hq_worksheet.get_all_values()
-        # Remove first 3 rows (column headers and instuctions/tips)
-        hidden_hq = hidden_hq[3:]
-        # Send for Mobilize Data
-        mobilize_dict = get_mobilize_data(hub)
-        # if not mobilize data
-        if mobilize_dict is None:
-            hq_errors.append([str(date.today()), 'mobilize_script', hub['hub_name'],
-                              f'''No mobilize events associated with hub email {hub['hub_email']}''', 'NA', 'NA'])
-            logger.info(f'''No mobilize events associated with hub {hub['hub_name']} email {hub['hub_email']}''')
-            continue
+
+@timed('compute')
+def mobilize_updates_windowed(hub: dict, mobilize_rows: MobilizeRows, hidden_hq_worksheet, hidden_hq_columns,
+                              append: bool = True, window_rows: int = HQ_WINDOW_ROWS,
+                              match_on_phone: bool = MATCH_ON_PHONE):
+    """
+    Streaming version of mobilize_updates for very large hubs. The Hidden HQ is read, matched and written back one
+    window of rows at a time with ranged reads and one batch update per window, and a bitmap of matched Mobilize rows
+    is all that's kept between windows. Mobilize rows without a match are then appended in chunks, so the whole sheet
+    is never held in memory
+    :param hub: dictionary for that hub from set up sheet, retrieved by parsons
+    :param mobilize_rows: MobilizeRows store of the hub's Mobilize data
+    :param hidden_hq_worksheet: HiddenHQ handle for the hub's sheet
+    :param hidden_hq_columns: dictionary indicating the index of each HQ column in the actual spreadsheet
+    :param append: if False, don't append the Mobilize rows without a match, e.g. for hubs with no new activity
+    :param window_rows: Hidden HQ rows read and written at a time
+    :param match_on_phone: if True, fall back to matching on phone number when the email doesn't match
+    :return: number of Mobilize rows appended
+    """
+    update_items = list(hidden_hq_columns.keys())[:hidden_hq_columns['status']]
+    first_column, status_column = hidden_hq_columns['total_signups'], hidden_hq_columns['status']
+    last_attendance_column = hidden_hq_columns['days_since_last_attendance']
+    matched = np.zeros(mobilize_rows.row_count, dtype=bool)
+    now = datetime.datetime.now(timezone.utc)
+    writes = SheetWriteBatch(hidden_hq_worksheet)
+    hq_rows, matched_hq_rows, phone_matches, cells_written = 0, 0, 0, 0
+    # Skip the first 3 rows (column headers and instuctions/tips)
+    for window_start, window in read_hidden_hq_windows(hidden_hq_worksheet, first_row=4, window_rows=window_rows):
+        hq_rows += len(window)
+        original_values = [hq_row[first_column:status_column + 1] for hq_row in window]
+        # Match the window's rows on normalized email, falling back to phone number if turned on
+        indices = mobilize_rows.lookup([normalize_email(hq_row[hidden_hq_columns['email']]) for hq_row in window])
+        if match_on_phone:
+            phone_indices = mobilize_rows.lookup_phones([
+                normalize_phone(hq_row[hidden_hq_columns['phone']]) if index < 0 else ''
+                for hq_row, index in zip(window, indices)])
+            phone_matches += int((phone_indices >= 0).sum())
+            indices = np.where(indices < 0, phone_indices, indices)
+        matched[indices[indices >= 0]] = True
+        matched_positions = np.flatnonzero(indices >= 0)
+        matched_hq_rows += len(matched_positions)
+
+        # Substitute mobilize values for hq values and assign status, the same as mobilize_updates
+        matched_mobilize_rows = [mobilize_rows.row(indices[position]) for position in matched_positions]
+        statuses = classify_statuses([row['date_joined'] for row in matched_mobilize_rows],
+                                     [row['total_signups'] for row in matched_mobilize_rows],
+                                     [row['days_since_last_signup'] for row in matched_mobilize_rows], now)
+        for position, mobilize_row, status in zip(matched_positions, matched_mobilize_rows, statuses):
+            for i in update_items:
+                window[position][hidden_hq_columns[i]] = mobilize_row[i]
+            window[position][status_column] = str(status)
+        is_matched = indices >= 0
+        event_attendance_updates = [
+            hq_row[first_column:status_column + 1] if row_matched else hq_row[first_column:last_attendance_column + 1]
+            for hq_row, row_matched in zip(window, is_matched)
+        ]
+        cell_updates, cells_changed = hq_cell_updates(original_values, event_attendance_updates,
+                                                      first_row=window_start, first_column=first_column + 1)
+        writes.batch_update(cell_updates)
+        writes.flush()
+        cells_written += cells_changed
+    metrics.add(rows=hq_rows)
+    unmatched = np.flatnonzero(mobilize_rows.unique & ~matched)
+    logger.info(f'''{hub['hub_name']}: {matched_hq_rows} of {hq_rows} HQ rows matched ({phone_matches} on phone), '''
+                f'''{len(unmatched)} new Mobilize contacts, {mobilize_rows.duplicate_emails} duplicate Mobilize '''
+                f'''emails, {cells_written} Hidden HQ cells written''')
+    if not append:
+        return 0
+
+    # Append the Mobilize rows without a match in date joined order, with status HOT LEAD like mobilize_updates. Rows
+    # are positional, lined up with the HQ columns
+    columns_to_append = ['first_name', 'last_name', 'email', 'phone', 'date_joined', 'total_signups',
+                         'total_attendances', 'first_signup', 'first_attendance', 'days_since_last_signup',
+                         'days_since_last_attendance']
+    for chunk_start in range(0, len(unmatched), window_rows):
+        writes.append_rows([[mobilize_rows.row(i)[column] for column in columns_to_append] + ['HOT LEAD']
+                            for i in unmatched[chunk_start:chunk_start + window_rows]])
+        writes.flush()
+    return len(unmatched)
+
+
+def process_hub_windowed(hub: dict, mobilize_dict, hidden_hq_worksheet, activity: str, idle: bool):
+    """
+    Run the Mobilize sync for one very large hub in streaming mode (see mobilize_updates_windowed). The Hidden HQ
+    snapshot isn't used, and is dropped since the sheet changes under it
+    :param hub: dictionary for that hub from set up sheet, retrieved by parsons
+    :param mobilize_dict: the hub's Mobilize data, as a MobilizeRows store or a dictionary of dictionaries
+    :param hidden_hq_worksheet: HiddenHQ handle for the hub's sheet
+    :param activity: the hub's activity string from get_hub_activity, saved to the sync state
+    :param idle: True if the hub has no new Mobilize activity or HQ edits since its last sync
+    :return: dictionary with the hub's rows for sunrise.hub_hq_errors under 'hq_errors'
+    """
+    hub_errors = []
+    if not isinstance(mobilize_dict, MobilizeRows):
+        mobilize_rows = MobilizeRows()
+        for row in mobilize_dict.values():
+            mobilize_rows.append(row)
+        mobilize_dict = mobilize_rows.freeze()
+    try:
+        # Idle hubs have no new Mobilize contacts to append
+        mobilize_updates_windowed(hub, mobilize_dict, hidden_hq_worksheet, hidden_hq_columns, append=not idle)
+    except Exception as e:
+        hub_errors.append(error_row('mobilize_script', hub['hub_name'], 'Error applying event sign up updates', e))
+    if clients.snapshot_store is not None:
+        clients.snapshot_store.delete(hub['spreadsheet_id'])
+    if not hub_errors:
+        clients.sync_state.save('mobilize_script', hub['spreadsheet_id'], hidden_hq_worksheet.modified_time(), activity)
+    return {'hq_errors': hub_errors}
+
+
+def process_hub(hub: dict, all_mobilize_dicts: dict, hub_activity: dict = None):
+    """
+    Run the Mobilize sync for one hub: read its Hidden HQ, apply the event attendance updates and append new Mobilize
+    contacts. Hubs with no new Mobilize activity and no HQ edits since their last sync only get the day based fields
+    (days since and status) refreshed from the snapshot, and are skipped if that already happened today. Hubs with
+    STREAMING_ROW_THRESHOLD or more Mobilize contacts or Hidden HQ rows are processed in streaming mode
+    :param hub: dictionary for that hub from set up sheet, retrieved by parsons
+    :param all_mobilize_dicts: output of get_all_mobilize_data
+    :param hub_activity: optional output of get_hub_activity. Without it, every hub gets the full sync
+    :return: dictionary with the hub's rows for sunrise.hub_hq_errors under 'hq_errors'
+    """
+    hub_errors = []
+    # Get the hub's Mobilize Data
+    mobilize_dict = get_mobilize_data(hub, all_mobilize_dicts)
+    # if not mobilize data
+    if mobilize_dict is None:
+        hub_errors.append([str(date.today()), 'mobilize_script', hub['hub_name'],
+                           f'''No mobilize events associated with hub email {hub['hub_email']}''', 'NA', 'NA'])
+        logger.info(f'''No mobilize events associated with hub {hub['hub_name']} email {hub['hub_email']}''')
+        return {'hq_errors': hub_errors}
+    # Connect to the hub's spreadsheet
+    hidden_hq_worksheet = connect_to_hq(hub)
+    modified_time = hidden_hq_worksheet.modified_time()
+    activity = (hub_activity or {}).get(hub['hub_email'].lower())
+    sync_state = clients.sync_state.load('mobilize_script', hub['spreadsheet_id'])
+    idle = (activity is not None and sync_state is not None and sync_state['activity'] == activity
+            and sync_state['modified_time'] == modified_time)
+    if idle and sync_state['synced_on'] == utc_today():
+        logger.info(f'''No changes for {hub['hub_name']} since it was synced today''')
+        metrics.add('other', skipped=1)
+        return {'hq_errors': hub_errors}
+    if isinstance(mobilize_dict, MobilizeRows) or hidden_hq_worksheet.row_count >= STREAMING_ROW_THRESHOLD:
+        return process_hub_windowed(hub, mobilize_dict, hidden_hq_worksheet, activity, idle)
+    # Get hidden hq table, only downloading it if it changed since the last run (when there's a snapshot store)
+    hq_snapshot = read_hidden_hq(hidden_hq_worksheet, clients.snapshot_store, modified_time)
+    # Remove first 3 rows (column headers and instuctions/tips). Rows are copied since mobilize_updates edits them
+    hidden_hq = [row[:] for row in hq_snapshot[3:]]
+    metrics.add('sheet_read', rows=len(hidden_hq))
+    appended_rows = []
+    # The hub's event attendance updates and new Mobilize contacts are queued and sent to the HQ in one batch update
+    writes = SheetWriteBatch(hidden_hq_worksheet)
+    # Try to send mobilize event attendance updates to HQ and get the left over mobilize rows for which no
+    # matches were found in HQ
+    try:
+        mobilize_parsons_append = mobilize_updates(hub, mobilize_dict, hidden_hq, hidden_hq_worksheet,
+                                                   hidden_hq_columns, writes=writes)
+        # Idle hubs have no new Mobilize contacts to append
+        if idle:
+            logger.info(f'''Refreshed days since and status for {hub['hub_name']}, which has no new activity''')
+        elif mobilize_parsons_append.num_rows == 0:
+            logger.info(f'''No new mobilize contacts for {hub['hub_name']}''')
         else:
-            # Try to send mobilize event attendance updates to HQ and get the left over mobilize rows for which no
-            # matches were found in HQ
-            try:
-                mobilize_parsons_append = mobilize_updates(hub, mobilize_dict, hidden_hq, hidden_hq_worksheet,
-                                                           hidden_hq_columns)
             # Append left over mobilize rows to HQ
-                try:
-                    parsons_sheets.append_to_sheet(hub['spreadsheet_id'], mobilize_parsons_append, 'Hidden HQ')
-                except ValueError as e:
-                    logger.info(f'''No new mobilize contacts for {hub['hub_name']}''')
-                except Exception as e:
-                    response = str(e)
-                    exceptiondata = traceback.format_exc().splitlines()
-                    exception = exceptiondata[len(exceptiondata) - 1]
-                    hq_errors.append([str(date.today()), 'mobilize_script', hub['hub_name'],
-                                      'Error applying event sign up updates', response[:999], exception[:999]])
-                    logger.info(f'''Error appending new mobilize contacts for {hub['hub_name']}''')
-            except Exception as e:
-                response = str(e)
-                exceptiondata = traceback.format_exc().splitlines()
-                exception = exceptiondata[len(exceptiondata) - 1]
-                hq_errors.append([str(date.today()), 'mobilize_script', hub['hub_name'],
-                                  'Error applying event sign up updates', response[:999], exception[:999]])
+            appended_rows = [list(row) for row in mobilize_parsons_append.data]
+            writes.append_rows(appended_rows)
+        timing = writes.flush()
+        if timing is not None:
+            logger.info(f'''{hub['hub_name']}: {timing['requests']} writes ({timing['cells']} cells) sent in one '''
+                        f'''batch update in {timing['seconds']:.2f}s''')
+        # Keep the snapshot in line with the event attendance values and appended rows that are now in the sheet,
+        # padded to the same width like get_all_values does. The modified time is left blank until the sync state is
+        # saved below
+        if clients.snapshot_store is not None:
+            first_column, last_column = hidden_hq_columns['total_signups'], hidden_hq_columns['status'] + 1
+            for snapshot_row, hq_row in zip(hq_snapshot[3:], hidden_hq):
+                snapshot_row[first_column:last_column] = [cell_value(value)
+                                                          for value in hq_row[first_column:last_column]]
+            hq_snapshot.extend([cell_value(value) for value in row] for row in appended_rows)
+            width = max([len(row) for row in hq_snapshot] + [0])
+            hq_snapshot = [row + [''] * (width - len(row)) for row in hq_snapshot]
+            clients.snapshot_store.save(hub['spreadsheet_id'], hq_snapshot)
+    except Exception as e:
+        hub_errors.append(error_row('mobilize_script', hub['hub_name'], 'Error applying event sign up updates', e))
+    # Remember what was synced, including the sheet's modified time after this run's writes, so the next run can tell
+    # whether anything changed
+    if not hub_errors:
+        modified_time = hidden_hq_worksheet.modified_time()
+        # The snapshot matches the sheet as written, so the next run can skip reading the sheet unless it's edited
+        if clients.snapshot_store is not None:
+            clients.snapshot_store.set_modified_time(hub['spreadsheet_id'], modified_time)
+        clients.sync_state.save('mobilize_script', hub['spreadsheet_id'], modified_time, activity)
+    return {'hq_errors': hub_errors}
+
+
+def main():
+    start_metrics('mobilize_script')
+    # Get cron job spreadsheet
+    hubs = get_hubs()
+    # Find the hubs with Mobilize activity since their last sync. Only their attendance state needs refreshing
+    hub_activity = get_hub_activity(hubs)
+    refresh_hub_emails = sorted({hub['hub_email'] for hub in hubs
+                                 if hub['hub_email'] and hub_activity_changed(hub, hub_activity)})
+    # Get Mobilize data for every hub in one query
+    all_mobilize_dicts = get_all_mobilize_data(hubs, refresh_hub_emails)
+    # Process hubs concurrently. Each hub's errors are collected separately and merged here for one copy to Redshift
+    results = run_hubs(hubs, partial(process_hub, all_mobilize_dicts=all_mobilize_dicts, hub_activity=hub_activity),
+                       'mobilize_script')
+    hq_errors = [['date', 'script', 'hub', 'error', 'traceback', 'other_messages']] + results['hq_errors']
     try:
-        rs.copy(Table(hq_errors), 'sunrise.hub_hq_errors', if_exists='append', distkey='hub',
+        clients.rs.copy(Table(hq_errors), 'sunrise.hub_hq_errors', if_exists='append', distkey='hub',
             sortkey='date', alter_table=True)
         logger.info(f'''{len(hq_errors)-1} errored hubs''')
     except ValueError:
         logger.info('Script executed without issue for all hubs')
+    try:
+        metrics.copy_to_redshift('mobilize_script')
+    except Exception as e:
+        logger.info(f'''Error copying metrics to Redshift: {e}''')
 
 if __name__ == '__main__':
     main()
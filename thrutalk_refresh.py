@@ -0,0 +1,245 @@
+# Civis container script
+
+# This script keeps the summary tables behind the ThruTalk dashboard (thrutalk_report_dashboard.sql) up to date, so the
+# dashboard reads small precomputed tables instead of scanning tmc_thrutalk.sun_call_results and sun_script_results
+# every time it loads. It materializes:
+# - the deduped call results (one row per call, the MAX ... GROUP BY id the dashboard used to do)
+# - each call's script answers pivoted into one row (the scale1, ballot_ready, votetrip and results1 CTEs)
+# Each run only re-reads the calls made since the newest date_called already materialized, less
+# THRUTALK_LOOKBACK_DAYS for calls that sync late. The tables are rebuilt from scratch when they don't exist yet or
+# their last full rebuild is older than THRUTALK_FULL_REFRESH_DAYS. Rebuilds empty and refill the tables in one
+# transaction instead of dropping them, so grants on the tables are kept
+
+# Import necessary packages
+from parsons import Redshift
+import logging
+import os
+
+##### Set up logger #####
+logger = logging.getLogger(__name__)
+_handler = logging.StreamHandler()
+_formatter = logging.Formatter('%(levelname)s %(message)s')
+_handler.setFormatter(_formatter)
+logger.addHandler(_handler)
+logger.setLevel('INFO')
+
+# Deduped call results, one row per call result id
+THRUTALK_RESULTS_TABLE = 'sunrise.thrutalk_results'
+# Script answers the dashboard uses, one row per call result id
+THRUTALK_ANSWERS_TABLE = 'sunrise.thrutalk_answers'
+# Newest date called materialized, and when the tables were last rebuilt from scratch
+THRUTALK_WATERMARKS_TABLE = 'sunrise.thrutalk_refresh_watermarks'
+THRUTALK_TABLES = [THRUTALK_RESULTS_TABLE, THRUTALK_ANSWERS_TABLE, THRUTALK_WATERMARKS_TABLE]
+# Calls made up to this many days before the watermark are read again, to pick up calls and answers that sync late
+THRUTALK_LOOKBACK_DAYS = 3
+# Rebuild the tables from the full call history at least this often, to pick up anything the lookback missed
+THRUTALK_FULL_REFRESH_DAYS = 7
+
+# Questions that hold the first candidate ID (trump to biden scale)
+SCALE_QUESTIONS = [
+    'trump_to_biden_scale',
+    'trump_to_biden_scale_checkbox_value_1',
+    'trump_to_biden_scale_checkbox_value_2',
+    'trump_to_biden_scale_checkbox_value_3',
+    'trump_to_biden_scale_checkbox_value_4',
+    'trump_to_biden_scale_checkbox_value_5',
+    'trump_to_biden_scale_checkbox_value_6',
+    'trump_to_biden_scale_checkbox_value_7',
+    'trump_to_biden_scale_checkbox_value_8',
+    'trump_to_biden_scale_checkbox_value_9'
+]
+
+
+def results_sql(call_filter: str = ''):
+    """
+    Build the query that dedupes call results. Duplicate records in results neccessitate MAX and GROUP BY statements
+    :param call_filter: optional where clause limiting which calls are read, e.g. to the calls being refreshed
+    :return: SQL string that returns one row per call result id
+    """
+    return f'''
+select
+    id
+    ,max(voter_phone) as voter_phone
+    ,max(voter_id) as voter_id
+    ,max(date_called) as date_called
+    ,max(service_account) as service_account
+    ,max(caller_login) as caller_login
+    ,max(result) as result
+from tmc_thrutalk.sun_call_results
+{call_filter}
+group by 1
+'''
+
+
+def answers_sql(call_filter: str = ''):
+    """
+    Build the query that pivots the script answers the dashboard uses into one row per call, in a single pass over the
+    script results instead of one per question:
+    - trump_to_biden: answer to the first candidate ID question
+    - ballot_ready: whether the caller walked the voter through making a vote plan using Ballot ready
+    - votetrip: names of 3 friends for vote trippling. If not null, they provided them
+    - first_question: answer to the start question, used to exclude wrong numbers, refused, ect. We need this because
+      sometimes callers enter call results wrong
+    :param call_filter: optional condition (starting with 'and') limiting which calls are read
+    :return: SQL string that returns one row per call result id
+    """
+    scale_questions = ', '.join(f"'{question}'" for question in SCALE_QUESTIONS)
+    start_answer = '''
+        answer ilike '%wrong%'
+        or answer ilike '%moved%'
+        or answer ilike '%talking%'
+        or answer ilike '%refused%'
+        or answer ilike '%deceased%'
+        or answer ilike '%disconnected%'
+        or answer ilike '%spanish%'
+    '''
+    return f'''
+select
+    call_result_id
+    ,max(case when question in ({scale_questions}) then answer end) as trump_to_biden
+    ,max(case when question like 'ballot_ready' then answer end) as ballot_ready
+    ,max(case when question ilike 'if_yes_to_vt_3_friends_names' then answer end) as votetrip
+    ,max(case when {start_answer} then answer end) as first_question
+from tmc_thrutalk.sun_script_results
+where
+(
+    question in ({scale_questions})
+    or question like 'ballot_ready'
+    or question ilike 'if_yes_to_vt_3_friends_names'
+    or {start_answer}
+)
+{call_filter}
+group by 1
+'''
+
+
+def rebuild_table_sql(table: str, table_attributes: str, query: str, create: bool):
+    """
+    Build the SQL that fills a summary table with the rows of a query
+    :param table: schema qualified table name
+    :param table_attributes: distkey/sortkey clause used when the table is created
+    :param query: SQL query for the table's rows
+    :param create: True if the table doesn't exist yet. It's created from the query, so its columns get the query's
+    types. Otherwise the table is emptied and refilled, which keeps its grants
+    :return: SQL string
+    """
+    if create:
+        return f'''
+create table {table} {table_attributes} as
+{query};
+'''
+    # delete rather than truncate, since truncate commits the transaction in Redshift
+    return f'''
+delete from {table};
+insert into {table}
+{query};
+'''
+
+
+def full_refresh_sql(missing_tables: list = ()):
+    """
+    Build the SQL that rebuilds the summary tables from the full call history. Tables are only created the first time;
+    after that they're emptied and refilled in the same transaction, so grants on them (e.g. for the dashboard) are kept
+    and the dashboard never sees them empty
+    :param missing_tables: summary tables that don't exist yet
+    :return: SQL string of statements to run in one transaction. It returns no rows
+    """
+    return (rebuild_table_sql(THRUTALK_RESULTS_TABLE, 'distkey(id) sortkey(date_called)', results_sql(),
+                              THRUTALK_RESULTS_TABLE in missing_tables)
+            + rebuild_table_sql(THRUTALK_ANSWERS_TABLE, 'distkey(call_result_id)', answers_sql(),
+                                THRUTALK_ANSWERS_TABLE in missing_tables)
+            + rebuild_table_sql(THRUTALK_WATERMARKS_TABLE, '', f'''
+select max(date_called::date) as watermark, getdate() as refreshed_at
+from {THRUTALK_RESULTS_TABLE}''', THRUTALK_WATERMARKS_TABLE in missing_tables))
+
+
+def incremental_refresh_sql():
+    """
+    Build the SQL that brings the summary tables up to date with the calls made since the watermark, less
+    THRUTALK_LOOKBACK_DAYS. Those calls are deduped and pivoted again from all of their raw rows and replace their rows
+    in the summary tables, so calls that were already materialized come out the same as a full rebuild
+    :return: SQL string of statements to run in one transaction. It returns no rows
+    """
+    return f'''
+-- calls made since the watermark
+create temp table changed_calls as
+select distinct id
+from tmc_thrutalk.sun_call_results
+where date_called::date >=
+(
+    select dateadd(day, -{THRUTALK_LOOKBACK_DAYS}, max(watermark)) from {THRUTALK_WATERMARKS_TABLE}
+);
+
+delete from {THRUTALK_RESULTS_TABLE}
+using changed_calls
+where {THRUTALK_RESULTS_TABLE}.id = changed_calls.id;
+
+insert into {THRUTALK_RESULTS_TABLE}
+{results_sql('where id in (select id from changed_calls)')};
+
+delete from {THRUTALK_ANSWERS_TABLE}
+using changed_calls
+where {THRUTALK_ANSWERS_TABLE}.call_result_id = changed_calls.id;
+
+insert into {THRUTALK_ANSWERS_TABLE}
+{answers_sql('and call_result_id in (select id from changed_calls)')};
+
+-- move the watermark up to the newest call
+update {THRUTALK_WATERMARKS_TABLE}
+set watermark = (select max(date_called::date) from {THRUTALK_RESULTS_TABLE});
+'''
+
+
+def connect_redshift():
+    """
+    Connect to Redshift with the credentials Civis gives container scripts, mapped to the environment variables parsons
+    reads (the same mapping as ClientRegistry.rs in the Hub HQ scripts)
+    :return: parsons Redshift object
+    """
+    # Set environ using civis credentials from container script
+    os.environ['REDSHIFT_DB'] = os.environ['REDSHIFT_DATABASE']
+    os.environ['REDSHIFT_USERNAME'] = os.environ['REDSHIFT_CREDENTIAL_USERNAME']
+    os.environ['REDSHIFT_PASSWORD'] = os.environ['REDSHIFT_CREDENTIAL_PASSWORD']
+    os.environ['S3_TEMP_BUCKET'] = 'parsons-tmc'
+    return Redshift()
+
+
+def needs_full_refresh(rs: Redshift, missing_tables: list):
+    """
+    Check whether the summary tables have to be rebuilt from scratch
+    :param rs: parsons Redshift object
+    :param missing_tables: the THRUTALK_TABLES that don't exist yet
+    :return: True if any of the tables don't exist yet or they haven't been rebuilt in THRUTALK_FULL_REFRESH_DAYS days
+    """
+    if missing_tables:
+        return True
+    recent = rs.query(sql=f'''
+select watermark
+from {THRUTALK_WATERMARKS_TABLE}
+where watermark is not null
+and refreshed_at >= dateadd(day, -{THRUTALK_FULL_REFRESH_DAYS}, getdate())
+''')
+    return recent is None or recent.num_rows == 0
+
+
+def main():
+    rs = connect_redshift()
+    missing_tables = [table for table in THRUTALK_TABLES if not rs.table_exists(table)]
+    if needs_full_refresh(rs, missing_tables):
+        logger.info('Rebuilding ThruTalk summary tables from the full call history')
+        rs.query(sql=full_refresh_sql(missing_tables))
+    else:
+        logger.info('Refreshing ThruTalk summary tables with the newest calls')
+        rs.query(sql=incremental_refresh_sql())
+    summary = rs.query(sql=f'''
+select
+    (select count(*) from {THRUTALK_RESULTS_TABLE}) as results
+    ,(select count(*) from {THRUTALK_ANSWERS_TABLE}) as answers
+    ,(select max(watermark) from {THRUTALK_WATERMARKS_TABLE})::text as watermark
+''')
+    logger.info(f'''{summary[0]['results']} call results and {summary[0]['answers']} calls with answers '''
+                f'''materialized, through {summary[0]['watermark']}''')
+
+
+if __name__ == '__main__':
+    main()
@@ -3,19 +3,20 @@ and areas of improvement for a ThruTalk call campaign during the 2020 presidenti
 CTEs beginning at line 500 return various counts/rates (e.g.positive ID rate) and 
 tables (e.g. number of calls by state) used to build all of the different charts.**/
 
--- Duplicate records in results neccessitates MAX and GROUP BY statements
+-- Deduped call results and pivoted script answers are materialized by thrutalk_refresh.py, which keeps
+-- sunrise.thrutalk_results and sunrise.thrutalk_answers up to date incrementally, so these CTEs read small precomputed
+-- tables instead of deduping tmc_thrutalk.sun_call_results and sun_script_results on every load
 WITH results AS 
 (
   SELECT 
   	id
-  	,MAX(voter_phone) AS voter_phone
-  	,MAX(voter_id) AS voter_id
-  	,MAX(date_called) AS date_called
-  	,MAX(service_account) AS service_account
-  	,MAX(caller_login) AS caller_login
-  	,MAX(result) AS result
-  FROM tmc_thrutalk.sun_call_results
-  GROUP BY 1
+  	,voter_phone
+  	,voter_id
+  	,date_called
+  	,service_account
+  	,caller_login
+  	,result
+  FROM sunrise.thrutalk_results
 ),
 
 -- Get script responses to first candidate ID question
@@ -23,22 +24,9 @@ scale1 AS
 (
   SELECT 
     call_result_id
-    ,MAX(answer) AS answer 
-  FROM tmc_thrutalk.sun_script_results 
-  WHERE question IN
-  (
-    'trump_to_biden_scale',
-    'trump_to_biden_scale_checkbox_value_1',
-    'trump_to_biden_scale_checkbox_value_2',
-    'trump_to_biden_scale_checkbox_value_3',
-    'trump_to_biden_scale_checkbox_value_4',
-    'trump_to_biden_scale_checkbox_value_5',
-    'trump_to_biden_scale_checkbox_value_6',
-    'trump_to_biden_scale_checkbox_value_7',
-    'trump_to_biden_scale_checkbox_value_8',
-    'trump_to_biden_scale_checkbox_value_9'
-  )
-  GROUP BY 1
+    ,trump_to_biden AS answer 
+  FROM sunrise.thrutalk_answers 
+  WHERE trump_to_biden IS NOT NULL
 ),
 
 -- Ballot ready question was where callers indicated whether or not they were able to walk voter through
@@ -47,10 +35,9 @@ ballot_ready AS
 (
   SELECT 
     call_result_id
-    ,MAX(answer) AS answer 
-  FROM tmc_thrutalk.sun_script_results 
-  WHERE question LIKE 'ballot_ready'
-  GROUP BY 1
+    ,ballot_ready AS answer 
+  FROM sunrise.thrutalk_answers 
+  WHERE ballot_ready IS NOT NULL
 ),
   
 -- Get answers to the vote tripple question where people provide 3 names of friends. If not null, then 
@@ -59,10 +46,9 @@ votetrip AS
 (
   SELECT
     call_result_id
-    ,MAX(answer) AS answer 
-  FROM tmc_thrutalk.sun_script_results 
-  WHERE question ILIKE 'if_yes_to_vt_3_friends_names'
-  GROUP BY 1
+    ,votetrip AS answer 
+  FROM sunrise.thrutalk_answers 
+  WHERE votetrip IS NOT NULL
 ),
   
 -- Get script responses for start question. This is to make sure we exclude everyone who has gotten a 
@@ -71,17 +57,9 @@ results1 AS
 (
   SELECT
     call_result_id
-    ,max(answer) AS answer 
-  FROM tmc_thrutalk.sun_script_results
-  WHERE 
-  	answer ilike '%wrong%'
-  	OR answer ILIKE '%moved%'
-  	OR answer ILIKE '%talking%'
-    OR answer ILIKE '%refused%'
-    OR answer ILIKE '%deceased%' 
-    OR answer ILIKE '%disconnected%' 
-    OR answer ILIKE '%spanish%'
-  GROUP BY 1
+    ,first_question AS answer 
+  FROM sunrise.thrutalk_answers
+  WHERE first_question IS NOT NULL
 ),
 
 --Bring it all together in the final base from which we will pull call metrics from 